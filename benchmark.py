@@ -0,0 +1,179 @@
+import os
+import io
+import json
+import shutil
+import time
+import subprocess
+import contextlib
+import warnings
+
+import pandas as pd
+import numpy as np
+
+from synthetic_sweep import generate_sweep
+
+# Benchmark of the pipeline on fake sweeps of different sizes (made by synthetic_sweep.generate_sweep).
+# For each scale the sweep is generated in "{workdir}/{scale}/synthetic" (only the first time, or when the scale
+# changed) and these stages are timed:
+#   generate   generate_sweep (only when the sweep is written)
+#   merge      q3merge.merge_all_q3_files
+#   load       Simulation.__init__
+#   pivot_df   pivot_df of 'max overlap' at line 1 for every (P, range), with empty caches
+#   heatmap    plot_heatmap_overlap_fluctuations_whichmax_3 of the first (P, range) at line 1
+#   raster     make_fig_spikes2 of the biggest spikes3 file
+# Every run of the benchmark adds its results (with the date and the git commit) to "{workdir}/benchmark-results.csv",
+# and compare_results shows the change of each stage from the previous run, to see regressions and speedups.
+
+# arguments of generate_sweep for each scale
+benchmark_scales = {
+    # about the size of example_simulation
+    'small': dict(numbers_of_patterns=[2, 10, 20], mixing_ranges=[1.0, 2.0, 2.5], sigmas=[1, 5.5, 10], deltas=[0, 1, 2]),
+    'medium': dict(numbers_of_patterns=[2, 5, 10, 20, 40], mixing_ranges=[1.0, 1.5, 2.0, 2.5],
+                   sigmas=np.linspace(1, 10, 10).tolist(), deltas=np.linspace(0, 2, 5).tolist()),
+    'large': dict(numbers_of_patterns=[2, 5, 10, 15, 20, 25, 30, 40, 50, 60], mixing_ranges=np.linspace(0.5, 4, 8).tolist(),
+                  sigmas=np.linspace(1, 10, 20).tolist(), deltas=np.linspace(0, 2, 10).tolist()),
+    # few runs with many spikes
+    'spikes': dict(numbers_of_patterns=[10], mixing_ranges=[1.0], sigmas=[1, 5.5, 10], deltas=[0, 1, 2], rate=100, tmax=3000),
+}
+benchmark_stages = ['generate', 'merge', 'load', 'pivot_df', 'heatmap', 'raster']
+results_name = 'benchmark-results.csv'
+
+def run_benchmark(workdir: str='./benchmark', scales: list=['small', 'medium'], repeat: int=1, workers: int=None) -> pd.DataFrame:
+    """
+    Runs the stages at the top of this file for each scale (names of benchmark_scales), keeping the best time of
+    'repeat' runs of each stage. The figures are made with the Agg backend and closed, the prints of the stages are hidden.
+    Returns the results, also added to "{workdir}/benchmark-results.csv", and prints the comparison with the previous run.
+    """
+    import matplotlib.pyplot as plt
+    backend = plt.get_backend()
+    plt.switch_backend('Agg')
+    rows = []
+    try:
+        for scale in scales:
+            rows += benchmark_scale(workdir, scale, repeat=repeat, workers=workers)
+    finally:
+        plt.switch_backend(backend)
+
+    results = pd.DataFrame(rows)
+    results.insert(0, 'date', pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S'))
+    results.insert(1, 'commit', git_commit())
+    results_path = os.path.join(workdir, results_name)
+    results.to_csv(results_path, mode='a', header=not os.path.isfile(results_path), index=False)
+    print(compare_results(results_path).to_string(float_format='{:.3f}'.format))
+    return results
+
+def benchmark_scale(workdir: str, scale: str, repeat: int=1, workers: int=None) -> list:
+    """
+    Generates the sweep of a scale if needed and times the stages on it, returns a list of rows (dictionaries)
+    """
+    import matplotlib.pyplot as plt
+    import seaborn  # imported before the timings, otherwise the first heatmap includes the import
+    import q3merge
+    from simulation_class import Simulation
+    from make_fig_spikes import make_fig_spikes2
+
+    arguments = dict(benchmark_scales[scale])
+    scale_dir = os.path.join(workdir, scale)
+    simulation_dir = os.path.join(scale_dir, 'synthetic')
+    rows = []
+
+    # the sweep is generated again only if the arguments of the scale changed
+    arguments_path = os.path.join(scale_dir, 'arguments.json')
+    saved_arguments = None
+    if os.path.isfile(arguments_path):
+        with open(arguments_path) as file:
+            saved_arguments = json.load(file)
+    if saved_arguments != arguments:
+        if os.path.isdir(simulation_dir):
+            shutil.rmtree(simulation_dir)
+        seconds = timed(lambda: generate_sweep(simulation_dir, workers=workers, **arguments), repeat=1)
+        os.makedirs(scale_dir, exist_ok=True)
+        with open(arguments_path, 'w') as file:
+            json.dump(arguments, file)
+        rows.append({'stage': 'generate', 'calls': 1, 'seconds': seconds})
+
+    # merge, with the parameters of q3merge.py set for this sweep
+    q3merge.simulation_name = 'synthetic'
+    q3merge.simulation_dir = simulation_dir
+    q3merge.savedir = os.path.join(simulation_dir, 'q3-synthetic')
+    q3merge.manifest_path = q3merge.savedir + '-manifest.csv'
+    q3merge.pout = arguments.get('pout', 20)
+    q3merge.max_lines = arguments.get('tmax', 300) // arguments.get('flush', 10)
+    seconds = timed(lambda: q3merge.merge_all_q3_files(workers=workers or 1), repeat=repeat)
+    rows.append({'stage': 'merge', 'calls': 1, 'seconds': seconds})
+
+    simulations = []
+    seconds = timed(lambda: simulations.append(Simulation(scale_dir, 'synthetic')), repeat=repeat)
+    rows.append({'stage': 'load', 'calls': 1, 'seconds': seconds})
+    simulation = simulations[-1]
+
+    keys = [(P, mixing_range) for P in simulation.int_n_patterns for mixing_range in simulation.float_mixing_ranges]
+    def make_pivots():
+        simulation.set_pivot_cache_size(simulation.pivot_cache_size)
+        for P, mixing_range in keys:
+            simulation.pivot_df('max overlap', P, mixing_range, 1)
+    rows.append({'stage': 'pivot_df', 'calls': len(keys), 'seconds': timed(make_pivots, repeat=repeat)})
+
+    def make_heatmap():
+        simulation.plot_heatmap_overlap_fluctuations_whichmax_3(*keys[0], 1)
+        plt.close('all')
+    rows.append({'stage': 'heatmap', 'calls': 1, 'seconds': timed(make_heatmap, repeat=repeat)})
+
+    spike_files = simulation.catalog[simulation.catalog['kind'] == 'spikes3']
+    spike_file = spike_files['path'][spike_files['size'].idxmax()]
+    def make_raster():
+        make_fig_spikes2(spike_file, time_fin=arguments.get('tmax', 300))
+        plt.close('all')
+    rows.append({'stage': 'raster', 'calls': 1, 'seconds': timed(make_raster, repeat=repeat)})
+
+    # size of the sweep
+    catalog = simulation.catalog[simulation.catalog['kind'] != 'dir']
+    for row in rows:
+        row.update({'scale': scale, 'runs': int((catalog['kind'] == 'q3').sum()), 'files': catalog.shape[0],
+                    'MB': catalog['size'].sum() / 1e6})
+    return [{key: row[key] for key in ['scale', 'runs', 'files', 'MB', 'stage', 'calls', 'seconds']} for row in rows]
+
+def timed(function, repeat: int=1) -> float:
+    """
+    Best time in seconds of 'repeat' calls of function, without its prints and warnings
+    """
+    best = np.inf
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()), warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            time_start = time.perf_counter()
+            function()
+            best = min(best, time.perf_counter() - time_start)
+    return best
+
+def compare_results(results_path: str) -> pd.DataFrame:
+    """
+    Seconds of each scale and stage in the last two runs of the benchmark saved in results_path,
+    with their ratio (> 1 means that the last run is slower)
+    """
+    results = pd.read_csv(results_path, dtype={'commit': str})
+    dates = sorted(results['date'].unique())
+    last = results[results['date'] == dates[-1]].set_index(['scale', 'stage'])
+    comparison = last[['runs', 'MB', 'seconds']].copy()
+    comparison['commit'] = last['commit']
+    if len(dates) > 1:
+        previous = results[results['date'] < dates[-1]].groupby(['scale', 'stage']).last()
+        comparison['previous seconds'] = previous['seconds'].reindex(comparison.index)
+        comparison['previous commit'] = previous['commit'].reindex(comparison.index)
+        comparison['ratio'] = comparison['seconds'] / comparison['previous seconds']
+    return comparison
+
+def git_commit() -> str:
+    """
+    Short hash of the git commit of this folder, '' if it is not a git repository
+    """
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True)
+    except OSError:
+        return ''
+    return result.stdout.strip()
+
+
+if __name__ == "__main__":
+    run_benchmark()
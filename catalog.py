@@ -0,0 +1,165 @@
+import os
+import re
+
+import pandas as pd
+import numpy as np
+
+# Catalog of all the output files of a simulation, made with a single walk of the directory tree.
+# Every file in the directories of the runs (named like "P-500--range-4.0") is a row with
+#   P, range                  from the name of the directory
+#   sigma, delta, alpha       from the name of the file if it has them (like "q3-5.5-0-0.5.dat"), NaN otherwise
+#   kind                      q3, spikes3, rate3, medie3, temp3, output, CONNESSIONI, PATTERN, sites3, matrice3, log or other
+#   path, size, mtime         mtime in ns
+# Each run directory is also a row with kind 'dir' (its mtime changes when files are added or removed).
+# The catalog can be saved in the simulation directory (save=True, done by q3merge.py) and it is used again as long
+# as the run directories are the same and have the same mtime, so most of the time only the run directories are
+# checked and not the files in them. The programs that only read the results (Simulation) do not save it, so they work
+# also on read only or shared directories; the file is written to a temporary file and renamed, so that two processes
+# saving it at the same time never leave half a file, and a directory that can not be written is not an error.
+# Sizes and modification times of the files are the ones at the time of the walk: use refresh=True (or os.stat)
+# if you need the current ones for files that are still being written. Appending to a file does not change the mtime
+# of its directory, and on NFS the mtime of a directory can be seen late by the other machines, so the saved catalog
+# may miss recent changes: refresh=True always walks the directories again.
+
+catalog_name = 'catalog.feather'
+catalog_columns = ['P', 'range', 'sigma', 'delta', 'alpha', 'kind', 'path', 'size', 'mtime']
+
+# files with sigma, delta and alpha in the name, like "q3-5.5-0-0.5.dat" or "output-5.5-0-0.5.txt"
+run_file_pattern = r'^(q3|spikes3|rate3|medie3|temp3|output)-([\d\.]+)-([\d\.]+)-([\d\.]+)\.(dat|txt)$'
+# files with a prefix only
+prefix_kinds = ['CONNESSIONI', 'PATTERN', 'sites3', 'matrice3', 'q3', 'spikes3', 'rate3', 'medie3', 'temp3']
+# binary copies made from the text files (like the caches of load_connessioni), they are 'other' also when their
+# name starts with a prefix of prefix_kinds, otherwise a run would have two CONNESSIONI files
+binary_extensions = ('.npy', '.npz')
+
+def file_kind(filename: str):
+    """
+    Returns kind, sigma, delta, alpha of a file of a run from its name (NaN when they are not in the name)
+    """
+    match = re.match(run_file_pattern, filename)
+    if match:
+        return match.group(1), float(match.group(2)), float(match.group(3)), float(match.group(4))
+    if filename.endswith(binary_extensions):
+        return 'other', np.nan, np.nan, np.nan
+    for kind in prefix_kinds:
+        if filename.startswith(kind):
+            return kind, np.nan, np.nan, np.nan
+    return 'other', np.nan, np.nan, np.nan
+
+def build_catalog(
+        simulation_dir: str,
+        directories_matching_pattern: str=r'P-([\d\.]+)--range-([\d\.]+)',
+        refresh: bool=False,
+        save: bool=False
+        ) -> pd.DataFrame:
+    """
+    Returns the catalog (see the top of this file) of a simulation directory.
+    The saved catalog is used if the run directories did not change, unless refresh is True.
+    With save=True the catalog is saved in the simulation directory when it was made again (see save_catalog).
+    Rows are in the order of os.scandir, which is the same as os.listdir.
+    """
+    catalog_path = os.path.join(simulation_dir, catalog_name)
+
+    # the run directories (and the .log files next to them) are always listed
+    run_dirs = []
+    log_rows = []
+    for entry in os.scandir(simulation_dir):
+        # without the extension, or the dot of ".log" ends up in the range
+        match = re.search(directories_matching_pattern, os.path.splitext(entry.name)[0] if entry.name.endswith('.log') else entry.name)
+        if not match:
+            continue
+        number_patterns, mixing_range = int(match.group(1)), float(match.group(2))
+        if entry.is_dir():
+            run_dirs.append((entry, number_patterns, mixing_range))
+        elif entry.name.endswith('.log'):
+            stat = entry.stat()
+            log_rows.append((number_patterns, mixing_range, np.nan, np.nan, np.nan, 'log', entry.path, stat.st_size, stat.st_mtime_ns))
+
+    dir_rows = [
+        (number_patterns, mixing_range, np.nan, np.nan, np.nan, 'dir', entry.path, 0, entry.stat().st_mtime_ns)
+        for entry, number_patterns, mixing_range in run_dirs
+    ]
+
+    catalog = None
+    if not refresh and os.path.isfile(catalog_path):
+        try:
+            catalog = pd.read_feather(catalog_path)
+        except (OSError, ValueError):
+            # written by an older version or damaged, it is made again
+            catalog = None
+    if catalog is not None:
+        saved_dirs = catalog[catalog['kind'] == 'dir']
+        if saved_dirs[['path', 'mtime']].values.tolist() == [[row[6], row[8]] for row in dir_rows]:
+            # the .log files are not inside the run directories, they are always up to date
+            return pd.concat([catalog[catalog['kind'] != 'log'], make_catalog(log_rows)], ignore_index=True)
+
+    rows = list(dir_rows)
+    for entry, number_patterns, mixing_range in run_dirs:
+        for file in os.scandir(entry.path):
+            if not file.is_file():
+                continue
+            kind, sigma, delta, alpha = file_kind(file.name)
+            stat = file.stat()
+            rows.append((number_patterns, mixing_range, sigma, delta, alpha, kind, file.path, stat.st_size, stat.st_mtime_ns))
+
+    catalog = make_catalog(rows)
+    if save:
+        save_catalog(catalog, catalog_path)
+    return pd.concat([catalog, make_catalog(log_rows)], ignore_index=True)
+
+def save_catalog(catalog: pd.DataFrame, catalog_path: str):
+    """
+    Writes the catalog to a temporary file and renames it to catalog_path (os.replace is atomic), so that the readers
+    see the old file or the new one and never half a file. If the directory can not be written it just prints it.
+    """
+    temporary_path = f'{catalog_path}.{os.getpid()}.tmp'
+    try:
+        catalog.to_feather(temporary_path)
+        os.replace(temporary_path, catalog_path)
+    except OSError as error:
+        print(purple(f"The catalog could not be saved in {catalog_path} ({error}), it is kept only in memory"))
+        try:
+            os.remove(temporary_path)
+        except OSError:
+            pass
+
+def make_catalog(rows: list) -> pd.DataFrame:
+    catalog = pd.DataFrame(rows, columns=catalog_columns)
+    return catalog.astype({'P': np.int64, 'range': np.float64, 'sigma': np.float64, 'delta': np.float64,
+                           'alpha': np.float64, 'kind': str, 'path': str, 'size': np.int64, 'mtime': np.int64})
+
+def files_of_kind(catalog: pd.DataFrame, kind: str) -> pd.DataFrame:
+    """
+    Returns the rows of the catalog with the selected kind (for example 'q3' or 'CONNESSIONI')
+    """
+    return catalog[catalog['kind'] == kind]
+
+def find_connessioni_files(catalog: pd.DataFrame, verbose: bool=False) -> pd.DataFrame:
+    """
+    Returns a dataframe with P, range and the path of the file CONNESSIONI of every run directory that has exactly one
+    """
+    rows = []
+    connessioni = files_of_kind(catalog, 'CONNESSIONI')
+    # a catalog saved before binary_extensions has the binary caches as CONNESSIONI files
+    connessioni = connessioni[~connessioni['path'].str.endswith(binary_extensions)]
+    for run_dir in files_of_kind(catalog, 'dir').itertuples():
+        matching_file_paths = connessioni['path'][(connessioni['P'] == run_dir.P) & (connessioni['range'] == run_dir.range)].tolist()
+
+        # Check if exactly one file matches the pattern
+        if len(matching_file_paths) == 1:
+            rows.append({'P': run_dir.P, 'range': run_dir.range, 'connessioni_file': matching_file_paths[0]})
+            if verbose:
+                print(f'dir = {os.path.basename(run_dir.path)}: P={run_dir.P}, range={run_dir.range}, single file CONNESSIONI found')
+        elif len(matching_file_paths) == 0:
+            print(purple("No file starting with 'CONNESSIONI' was found."))
+        else:
+            print(purple("Multiple files starting with 'CONNESSIONI' were found."))
+
+    return pd.DataFrame(rows, columns=['P', 'range', 'connessioni_file'])
+
+def purple(string: str):
+    return "\033[95m" + string + "\033[0m"
+
+
+if __name__ == "__main__":
+    print(build_catalog(r'./example_simulation', refresh=True, save=True))
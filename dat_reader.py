@@ -0,0 +1,167 @@
+import os
+import re
+import io
+import glob
+import time
+import itertools
+
+import pandas as pd
+import numpy as np
+
+# Reader of the .dat files written by the simulations (q3, spikes3, medie3, temp3, rate3).
+# They are tables of numbers separated by spaces, always with the same number of columns, with '-nan' for 0/0.
+# np.loadtxt (with the C parser of numpy >= 1.23) reads them much faster than pd.read_csv(sep='\s+'),
+# especially the small q3 files where most of the time of pandas is spent before reading the data (see benchmark).
+# Tables it can not read (for example with a last line that is only half written because the simulation is still
+# running) are read with pandas, which fills the missing values with NaN.
+
+# dtype of the columns of each kind of file: a single dtype for all the columns, or a list with the dtype of the
+# first columns and the last one repeated for the remaining columns
+dat_dtypes = {
+    'q3': [np.float64],
+    'medie3': [np.float64],
+    'temp3': [np.float64],
+    'rate3': [np.float64],
+    # time, cue flag, neuron, position of the neuron in each pattern
+    'spikes3': [np.float64, np.uint8, np.uint32],
+}
+
+def dat_kind(path: str) -> str:
+    """
+    Kind of a .dat file ('q3', 'spikes3', ...) from its name, None if it is not one of dat_dtypes
+    """
+    name = os.path.basename(path)
+    for kind in dat_dtypes:
+        if name.startswith(kind + '-'):
+            return kind
+    return None
+
+def parse_lines(lines) -> np.ndarray:
+    """
+    Parses an iterable of lines (str or bytes) of a .dat file in a float64 array with one row per line
+    """
+    try:
+        return np.loadtxt(lines, dtype=np.float64, ndmin=2)
+    except ValueError:
+        # rows with a different number of columns (or values that are not numbers)
+        if not isinstance(lines, (list, tuple)):
+            raise
+        text = b''.join(lines).decode() if lines and isinstance(lines[0], bytes) else ''.join(lines)
+        return pd.read_csv(io.StringIO(text), sep=r'\s+', header=None, na_values=['-nan', 'nan'], dtype=np.float64).to_numpy()
+
+def read_dat(path: str) -> np.ndarray:
+    """
+    Reads a whole .dat file in a float64 array (rows x columns), '-nan' become NaN
+    """
+    if os.path.getsize(path) == 0:
+        return np.empty((0, 0))
+    try:
+        return np.loadtxt(path, dtype=np.float64, ndmin=2)
+    except ValueError:
+        with open(path, 'rb') as file:
+            return parse_lines(file.readlines())
+
+def iter_dat_chunks(file, chunksize: int=1_000_000):
+    """
+    Yields float64 arrays with at most 'chunksize' lines of a .dat file (a path or a file already open, that is
+    read from its current position), so that only one chunk at a time is in memory.
+    """
+    if isinstance(file, str):
+        with open(file, 'rb') as opened_file:
+            yield from iter_dat_chunks(opened_file, chunksize=chunksize)
+        return
+
+    while True:
+        lines = list(itertools.islice(file, chunksize))
+        if not lines:
+            return
+        yield parse_lines(lines)
+
+def to_dataframe(values: np.ndarray, kind: str=None) -> pd.DataFrame:
+    """
+    Headerless dataframe (columns 0, 1, 2, ...) of an array from read_dat or iter_dat_chunks,
+    with the dtypes of the kind of file in dat_dtypes (float64 if kind is None)
+    """
+    dtypes = dat_dtypes.get(kind, [np.float64])
+    if all(dtype == np.float64 for dtype in dtypes):
+        # a single block, without copying the values
+        return pd.DataFrame(values, copy=False)
+    columns = {}
+    for i in range(values.shape[1]):
+        dtype = dtypes[min(i, len(dtypes) - 1)]
+        column = values[:, i]
+        # integer columns with NaN (rows not complete) stay float
+        if np.issubdtype(dtype, np.integer) and np.isnan(column).any():
+            dtype = np.float64
+        columns[i] = column.astype(dtype, copy=False)
+    return pd.DataFrame(columns, copy=False)
+
+def read_run_parameters(output_file: str) -> dict:
+    """
+    Reads the parameters (lines like "tmax=300   tempo massimo simulazione") from an output file of a run
+    (output-sigma-delta-alpha.txt or output-connessioni.txt). Values are strings.
+    """
+    parameters = {}
+    with open(output_file) as file:
+        for line in file:
+            match = re.match(r'^(\w+)=(\S*)', line)
+            if match:
+                parameters[match.group(1)] = match.group(2)
+    return parameters
+
+def read_dat_df(path: str, kind: str=None) -> pd.DataFrame:
+    r"""
+    Reads a whole .dat file in a headerless dataframe with the dtypes of its kind (from the name of the file if kind is None).
+    Same result as pd.read_csv(path, sep='\s+', header=None), apart from the dtypes, but faster.
+    """
+    return to_dataframe(read_dat(path), kind=kind if kind is not None else dat_kind(path))
+
+def benchmark(simulation_dir: str=r'./example_simulation', repeat: int=3) -> pd.DataFrame:
+    r"""
+    Compares the time to read all the q3 and spikes3 files of a simulation with pd.read_csv(sep='\s+') and with read_dat_df,
+    checking that the values are the same. Returns (and prints) a dataframe with the best time of 'repeat' runs.
+    """
+    rows = []
+    for kind in ['q3', 'spikes3']:
+        files = sorted(glob.glob(os.path.join(simulation_dir, '*', kind + '-*.dat')))
+        if not files:
+            continue
+        readers = {
+            'pandas': lambda path: pd.read_csv(path, sep=r'\s+', header=None),
+            'dat_reader': lambda path: read_dat_df(path, kind=kind),
+        }
+        seconds = {}
+        for name, reader in readers.items():
+            best = np.inf
+            for _ in range(repeat):
+                time_start = time.perf_counter()
+                for path in files:
+                    reader(path)
+                best = min(best, time.perf_counter() - time_start)
+            seconds[name] = best
+
+        for path in files:
+            expected = readers['pandas'](path).to_numpy(dtype=np.float64)
+            if not np.array_equal(expected, read_dat(path), equal_nan=True):
+                raise ValueError(purple(f"benchmark: different values read from {path}"))
+
+        size = sum(os.path.getsize(path) for path in files)
+        rows.append({
+            'kind': kind,
+            'files': len(files),
+            'MB': size / 1e6,
+            'pandas [s]': seconds['pandas'],
+            'dat_reader [s]': seconds['dat_reader'],
+            'speedup': seconds['pandas'] / seconds['dat_reader'],
+        })
+
+    result = pd.DataFrame(rows)
+    print(result.to_string(index=False, float_format='{:.3f}'.format))
+    return result
+
+def purple(string: str):
+    return "\033[95m" + string + "\033[0m"
+
+
+if __name__ == "__main__":
+    benchmark(r'./example_simulation')
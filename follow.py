@@ -0,0 +1,265 @@
+import os
+import re
+import time
+
+import pandas as pd
+import numpy as np
+
+from catalog import file_kind
+from dat_reader import parse_lines, to_dataframe, read_run_parameters
+from q3merge import format_df
+
+# Follows a sweep while it is running, without reading the files again from the start.
+# For every q3 and spikes3 file the position reached in the last poll is kept, so each poll reads only the bytes
+# added since then (a line that is only half written is kept and completed in the next poll).
+#   q3       the new rows are written in place in a merged dataframe like the one of q3merge.py (same columns and lines),
+#            a file that appears adds its block of max_lines rows
+#   spikes3  only the files passed to follow_spikes are read, the spikes are kept in memory (only the last 'window' ms
+#            if window is not None) and update_raster redraws an open raster with them
+# At each poll the run directories are checked with os.stat, and they are listed again only if their mtime changed
+# (a file was added), so without new data a poll costs one stat per run directory and per followed file.
+# Use Simulation(..., follow=True) and Simulation.refresh() to see the new data in the heatmaps.
+
+class Tail:
+    """
+    Reads the lines added to a .dat file since the last call of read_new_lines
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0
+        self.partial = b''
+
+    def read_new_lines(self) -> np.ndarray:
+        """
+        Returns the complete lines added since the last call as a float64 array (rows x columns), None if there are none.
+        If the file became shorter (it was written again from the start) it is read from the start.
+        """
+        size = os.stat(self.path).st_size
+        if size < self.offset:
+            self.offset = 0
+            self.partial = b''
+        if size == self.offset:
+            return None
+
+        with open(self.path, 'rb') as file:
+            file.seek(self.offset)
+            data = self.partial + file.read(size - self.offset)
+        self.offset = size
+
+        # the last line may still be being written
+        end = data.rfind(b'\n') + 1
+        self.partial = data[end:]
+        lines = [line for line in data[:end].splitlines(keepends=True) if line.strip()]
+        if not lines:
+            return None
+        return parse_lines(lines)
+
+class Follower:
+    """
+    Keeps an in memory merged q3 dataframe (and the spikes of some spikes3 files) up to date with a running simulation,
+    see the top of this file.
+    pout and max_lines are read from the output file of the first run found when they are None (max_lines = tmax / flush).
+    """
+    def __init__(
+            self,
+            simulation_dir: str,
+            directories_matching_pattern: str=r'P-([\d\.]+)--range-([\d\.]+)',
+            pout: int=None,
+            max_lines: int=None,
+            ):
+        self.dir = simulation_dir
+        self.directories_matching_pattern = directories_matching_pattern
+        self.pout = pout
+        self.max_lines = max_lines
+
+        self.run_dirs = {}  # path: (P, range, mtime)
+        self.q3_tails = {}  # path: (Tail, P, range), for the files seen in the run directories
+        self.q3_blocks = {}  # path: [first row of the file in q3_df, rows read]
+        self.q3_df = None
+        self.spike_tails = {}  # path: Tail
+        self.spike_chunks = {}  # path: list of arrays of the spikes read
+        self.spike_windows = {}  # path: ms of spikes kept, None for all
+        self.rasters = {}  # (path, id of the ax): scatter
+
+    def scan(self) -> int:
+        """
+        Adds the q3 files of the run directories that changed since the last scan, returns how many were added
+        """
+        added = 0
+        for entry in os.scandir(self.dir):
+            match = re.search(self.directories_matching_pattern, entry.name)
+            if not match or not entry.is_dir():
+                continue
+            mtime = entry.stat().st_mtime_ns
+            if self.run_dirs.get(entry.path, (None, None, None))[2] == mtime:
+                continue
+            number_patterns, mixing_range = int(match.group(1)), float(match.group(2))
+            self.run_dirs[entry.path] = (number_patterns, mixing_range, mtime)
+
+            for file in os.scandir(entry.path):
+                kind = file_kind(file.name)[0]
+                if kind == 'output' and (self.pout is None or self.max_lines is None):
+                    parameters = read_run_parameters(file.path)
+                    if self.pout is None:
+                        self.pout = int(parameters['pout'])
+                    if self.max_lines is None:
+                        self.max_lines = int(float(parameters['tmax']) / float(parameters['flush']))
+                elif kind == 'q3' and file.path not in self.q3_tails and file.name.endswith('.dat'):
+                    self.q3_tails[file.path] = (Tail(file.path), number_patterns, mixing_range)
+                    added += 1
+        return added
+
+    def poll(self) -> dict:
+        """
+        Reads what was added to the files since the last poll. Returns a dictionary with
+            'new q3 files'   number of q3 files added to q3_df
+            'new q3 rows'    number of rows of q3_df that changed
+            'rows'           positions in q3_df of the rows that changed (of the files already in q3_df)
+            'new spikes'     number of spikes read from the followed spikes3 files
+        """
+        self.scan()
+        if self.pout is None or self.max_lines is None:
+            raise ValueError(purple("Follower: no output file to read pout and max_lines from, pass them to Follower"))
+
+        new_blocks = []
+        rows = []
+        updates = []
+        new_rows = 0
+        number_rows = 0 if self.q3_df is None else self.q3_df.shape[0]
+        for path, (tail, number_patterns, mixing_range) in self.q3_tails.items():
+            values = tail.read_new_lines()
+            if values is None:
+                continue
+            new_rows += values.shape[0]
+            block = self.q3_blocks.get(path)
+            if block is None:
+                # the block of a new file is made as in q3merge.py, the next rows are written in place
+                new_blocks.append(format_df(pd.DataFrame(values), number_patterns=number_patterns, mixing_range=mixing_range,
+                                            number_observed=self.pout, number_lines=self.max_lines))
+                self.q3_blocks[path] = [number_rows, values.shape[0]]
+                number_rows += self.max_lines
+                continue
+
+            first, read = block
+            if read + values.shape[0] > self.max_lines:
+                raise TypeError(purple(f"Follower: {path} has more than max lines ({self.max_lines}) rows"))
+            rows.append(np.arange(first + read, first + read + values.shape[0]))
+            updates.append(values)
+            block[1] += values.shape[0]
+
+        if rows:
+            # all the rows of the poll are written at once (pandas sets one column at a time),
+            # the data columns (NaN where the file has less columns) and the rate
+            number_data_cols = 9 + 2 * self.pout
+            values = np.full((sum(update.shape[0] for update in updates), number_data_cols + 1), np.nan)
+            first = 0
+            for update in updates:
+                values[first:first + update.shape[0], :update.shape[1]] = update
+                first += update.shape[0]
+            with np.errstate(divide='ignore', invalid='ignore'):  # same as format_df
+                values[:, -1] = values[:, 5] / (values[:, 4] - values[:, 3])
+            columns = list(range(number_data_cols)) + [self.q3_df.columns.get_loc('rate')]
+            self.q3_df.iloc[np.concatenate(rows), columns] = values
+
+        if new_blocks:
+            self.q3_df = pd.concat(([] if self.q3_df is None else [self.q3_df]) + new_blocks, ignore_index=True)
+
+        new_spikes = 0
+        for path, tail in self.spike_tails.items():
+            values = tail.read_new_lines()
+            if values is None:
+                continue
+            new_spikes += values.shape[0]
+            chunks = self.spike_chunks[path]
+            chunks.append(values)
+            window = self.spike_windows[path]
+            if window is not None:
+                # drop the chunks that ended before the window
+                last_time = values[-1, 0]
+                while chunks and chunks[0][-1, 0] < last_time - window:
+                    chunks.pop(0)
+
+        return {
+            'new q3 files': len(new_blocks),
+            'new q3 rows': new_rows,
+            'rows': np.concatenate(rows) if rows else np.empty(0, dtype=np.int64),
+            'new spikes': new_spikes,
+        }
+
+    def follow_spikes(self, spike_file: str, window: float=None):
+        """
+        Starts following a spikes3 file (from its start): the spikes are read at each poll and kept in memory,
+        only the last 'window' ms if window is not None.
+        """
+        if spike_file not in self.spike_tails:
+            self.spike_tails[spike_file] = Tail(spike_file)
+            self.spike_chunks[spike_file] = []
+        self.spike_windows[spike_file] = window
+
+    def spikes(self, spike_file: str, time_ini=0, time_fin=np.inf) -> pd.DataFrame:
+        """
+        Spikes read so far from a followed spikes3 file with time_ini <= time <= time_fin, in a headerless dataframe
+        like make_fig_spikes.read_spikes
+        """
+        chunks = self.spike_chunks[spike_file]
+        if not chunks:
+            return to_dataframe(np.empty((0, 3)), kind='spikes3')
+        values = np.concatenate(chunks)
+        values = values[(values[:, 0] >= time_ini) & (values[:, 0] <= time_fin)]
+        return to_dataframe(values, kind='spikes3')
+
+    def update_raster(self, spike_file: str, ax, pattern: int=0, window: float=500, sizes=None, alpha=0.7):
+        """
+        Draws on ax the raster of the last 'window' ms of a followed spikes3 file, with the neurons in the order of 'pattern'
+        (same colors as make_fig_spikes.make_fig_spikes2). The first call makes the scatter, the next ones only change its points.
+        """
+        from matplotlib.colors import ListedColormap
+
+        chunks = self.spike_chunks[spike_file]
+        if not chunks:
+            return None
+        last_time = chunks[-1][-1, 0]
+        df = self.spikes(spike_file, time_ini=last_time - window)
+        times = df[0].to_numpy()
+        neurons = df[3 + pattern].to_numpy()
+        cue = df[1].to_numpy(dtype=np.int64)
+        sizes = np.asarray(sizes if sizes else [10, 25])
+
+        scatter = self.rasters.get((spike_file, id(ax)))
+        if scatter is None:
+            scatter = ax.scatter(times, neurons, c=cue, cmap=ListedColormap(['blue', 'red']), vmin=0, vmax=1,
+                                 s=sizes[cue], alpha=alpha, edgecolors=None, marker='|', zorder=4)
+            self.rasters[(spike_file, id(ax))] = scatter
+        else:
+            scatter.set_offsets(np.column_stack([times, neurons]))
+            scatter.set_array(cue)
+            scatter.set_sizes(sizes[cue])
+
+        greatest_neuron = int(neurons.max()) if neurons.shape[0] else 1
+        ax.set_xlim(last_time - window, last_time)
+        ax.set_ylim(-greatest_neuron * 5 // 100, greatest_neuron * 105 // 100)
+        ax.figure.canvas.draw_idle()
+        return scatter
+
+def watch(follower, interval: float=10, callback=None, polls: int=None):
+    """
+    Polls every 'interval' seconds (forever if polls is None) and calls callback(changes) when something was added.
+    follower can be a Follower or a Simulation made with follow=True (then the heatmaps are refreshed too).
+    """
+    poll = follower.refresh if hasattr(follower, 'refresh') else follower.poll
+    count = 0
+    while polls is None or count < polls:
+        changes = poll()
+        if callback is not None and (changes['new q3 rows'] or changes['new spikes']):
+            callback(changes)
+        count += 1
+        if polls is None or count < polls:
+            time.sleep(interval)
+
+def purple(string: str):
+    return "\033[95m" + string + "\033[0m"
+
+
+if __name__ == "__main__":
+    follower = Follower(r'./example_simulation')
+    watch(follower, interval=10, callback=lambda changes: print(f"{changes['new q3 rows']} new q3 rows, {changes['new spikes']} new spikes"))
@@ -0,0 +1,192 @@
+import os
+import sys
+import json
+import time
+import inspect
+import threading
+import functools
+import contextlib
+import tracemalloc
+
+import pandas as pd
+
+try:
+    import resource  # not on Windows
+except ImportError:
+    resource = None
+
+# Opt-in timing and memory of the methods of Simulation and of the functions of simulation_class.py and q3merge.py
+# (also the ones of the other files of this folder that they use, like build_catalog).
+#     import instrumentation
+#     instrumentation.enable()              # or enable(memory=True), or "with instrumentation.profile():"
+#     sim = Simulation(...); sim.plot_heatmap_overlap_fluctuations_whichmax_3(...)
+#     instrumentation.report()              # table with calls, time and memory of each function
+#     instrumentation.export('profile.json')
+# enable replaces the functions with wrappers that record every call and disable puts the original ones back,
+# so when it is not enabled nothing is recorded and there is no overhead at all. enable can be called before or after
+# the Simulation objects are made: their caches (pivots, slices and frames) look up the methods at every call.
+# For each function: number of calls, total, mean and max wall time (of the function and of the functions it calls),
+# the largest increase of the peak RSS of the process during a call and, with memory=True, the largest peak of the
+# memory allocated by python during a call (tracemalloc, which makes python slower while it is on).
+# Calls made in worker processes (merge with workers > 1, export_heatmaps) are counted in the function that waits for them.
+
+# {name: [calls, total seconds, max seconds, max tracemalloc peak in bytes, max RSS increase in bytes]}
+records = {}
+# calls in order, for export: (name, start in seconds from enable, seconds, thread id)
+events = []
+
+_patched = []  # (owner, attribute, original value)
+_lock = threading.Lock()
+_local = threading.local()  # stack of the tracemalloc peaks of the calls of each thread
+_memory = False
+_time_start = 0.0
+
+def enable(memory: bool=False, targets: list=None):
+    """
+    Starts recording the calls of the functions and methods of targets (modules or classes), by default
+    Simulation, simulation_class and q3merge. With memory=True tracemalloc is started too.
+    """
+    global _memory, _time_start
+    if _patched:
+        disable()
+    if targets is None:
+        import q3merge
+        import simulation_class
+        targets = [simulation_class.Simulation, simulation_class, q3merge]
+
+    for target in targets:
+        # q3merge.py is __main__ when it is launched as a script
+        prefix = target.__name__ if inspect.isclass(target) else os.path.splitext(os.path.basename(target.__file__))[0]
+        for attribute, value in list(vars(target).items()):
+            if isinstance(value, staticmethod) and inspect.isfunction(value.__func__):
+                wrapped = staticmethod(wrap(value.__func__, f'{prefix}.{attribute}'))
+            elif inspect.isfunction(value) and is_local(value) and (attribute == '__init__' or not attribute.startswith('__')):
+                wrapped = wrap(value, f'{prefix}.{attribute}')
+            else:
+                continue
+            _patched.append((target, attribute, value))
+            setattr(target, attribute, wrapped)
+
+    _memory = memory
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    _time_start = time.perf_counter()
+
+def disable():
+    """
+    Puts back the original functions (the records are kept until reset)
+    """
+    global _memory
+    while _patched:
+        target, attribute, value = _patched.pop()
+        setattr(target, attribute, value)
+    if _memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    _memory = False
+
+def reset():
+    """
+    Deletes the records
+    """
+    with _lock:
+        records.clear()
+        events.clear()
+
+@contextlib.contextmanager
+def profile(memory: bool=False, targets: list=None):
+    """
+    Records the calls only inside a with block, then prints the report
+    """
+    enable(memory=memory, targets=targets)
+    try:
+        yield
+    finally:
+        disable()
+        report()
+
+def is_local(function) -> bool:
+    """
+    True if the function comes from a file of this folder (not from pandas, numpy, ...)
+    """
+    module = sys.modules.get(function.__module__)
+    path = getattr(module, '__file__', None)
+    return path is not None and os.path.dirname(os.path.abspath(path)) == os.path.dirname(os.path.abspath(__file__))
+
+def wrap(function, name: str):
+    """
+    Returns a wrapper of function that records its calls with the name 'name'
+    """
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        rss_start = max_rss()
+        memory = _memory
+        if memory:
+            # the peak of the caller is saved before resetting it, and updated when this call ends
+            current, peak = tracemalloc.get_traced_memory()
+            stack = getattr(_local, 'stack', None)
+            if stack is None:
+                stack = _local.stack = []
+            if stack:
+                stack[-1] = max(stack[-1], peak)
+            stack.append(0)
+            tracemalloc.reset_peak()
+        time_start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            seconds = time.perf_counter() - time_start
+            memory_peak = 0
+            if memory and tracemalloc.is_tracing():
+                peak = max(_local.stack.pop(), tracemalloc.get_traced_memory()[1])
+                memory_peak = peak - current
+                if _local.stack:
+                    _local.stack[-1] = max(_local.stack[-1], peak)
+            rss_increase = max_rss() - rss_start
+            with _lock:
+                record = records.setdefault(name, [0, 0.0, 0.0, 0, 0])
+                record[0] += 1
+                record[1] += seconds
+                record[2] = max(record[2], seconds)
+                record[3] = max(record[3], memory_peak)
+                record[4] = max(record[4], rss_increase)
+                events.append((name, time_start - _time_start, seconds, threading.get_ident()))
+    return wrapper
+
+def max_rss() -> int:
+    """
+    Peak RSS of the process in bytes (0 where the resource module is not available)
+    """
+    if resource is None:
+        return 0
+    # kilobytes on Linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+
+def report(show: bool=True) -> pd.DataFrame:
+    """
+    Returns (and prints if show is True) a table with the records of each function, from the largest total time
+    """
+    with _lock:
+        rows = [[name] + record for name, record in records.items()]
+    df = pd.DataFrame(rows, columns=['function', 'calls', 'total [s]', 'max [s]', 'tracemalloc peak [MB]', 'RSS increase [MB]'])
+    df.insert(3, 'mean [s]', df['total [s]'] / df['calls'])
+    df['tracemalloc peak [MB]'] /= 1e6
+    df['RSS increase [MB]'] /= 1e6
+    df = df.sort_values('total [s]', ascending=False, ignore_index=True)
+    if show:
+        print(df.to_string(index=False, float_format='{:.4f}'.format))
+    return df
+
+def export(path: str):
+    """
+    Saves the records: the table of report for a .csv file, otherwise every call in the trace event format (.json),
+    which can be opened with chrome://tracing or https://ui.perfetto.dev to see the calls on a timeline.
+    """
+    if os.path.splitext(path)[1] == '.csv':
+        report(show=False).to_csv(path, index=False)
+    else:
+        with _lock:
+            trace = [{'name': name, 'ph': 'X', 'ts': start * 1e6, 'dur': seconds * 1e6, 'pid': os.getpid(), 'tid': thread}
+                     for name, start, seconds, thread in events]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, file)
+    print(f"instrumentation: saved {path}")
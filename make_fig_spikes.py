@@ -1,13 +1,70 @@
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
 
 import matplotlib.pyplot as plt
-from matplotlib.colors import ListedColormap
+from matplotlib.colors import ListedColormap, LinearSegmentedColormap
 import matplotlib.patches as mpatches
 
 import pandas as pd
 import numpy as np
 
+from spike_store import store_extension, read_spike_store
+from catalog import build_catalog, files_of_kind
+from dat_reader import iter_dat_chunks, to_dataframe
+
+def read_spikes(spike_file: str, time_ini=0, time_fin=np.inf, chunksize: int=100_000):
+    """
+    Reads from a spikes3 .dat file only the spikes with time_ini <= time <= time_fin, in a headerless dataframe.
+    Spike times are written in increasing order, so the first spike of the window is found with a binary search
+    on the bytes of the file and then the file is read in chunks of 'chunksize' lines until time_fin.
+    This way memory and time depend on the size of the window and not on the size of the file.
+    """
+    with open(spike_file, 'rb') as file:
+        # number of columns (3 + number of patterns), needed if there are no spikes in the window
+        number_cols = len(file.readline().split())
+
+        file.seek(find_time_offset(file, time_ini))
+        chunks = []
+        for values in iter_dat_chunks(file, chunksize=chunksize):
+            chunk = to_dataframe(values, kind='spikes3')
+            times = chunk[0]
+            chunks.append(chunk[(times >= time_ini) & (times <= time_fin)])
+            # the rest of the file is after the window
+            if times.iloc[-1] > time_fin:
+                break
+
+    if not chunks:
+        return pd.DataFrame(columns=range(number_cols), dtype=np.float64)
+    return pd.concat(chunks, ignore_index=True)
+
+def find_time_offset(file, time, block_size: int=1 << 16):
+    """
+    Binary search in a spikes3 file (opened in binary mode) ordered by time.
+    Returns the offset of the start of a line that comes before the first spike with time >= 'time'
+    (at most about block_size bytes before it).
+    """
+    file.seek(0, os.SEEK_END)
+    low, high = 0, file.tell()
+
+    while high - low > block_size:
+        middle = (low + high) // 2
+        file.seek(middle)
+        file.readline()  # skip the rest of the line that contains middle
+        line = file.readline()
+        if not line or float(line.split()[0]) >= time:
+            high = middle
+        else:
+            low = middle
+
+    # go to the start of the first complete line after low
+    if low > 0:
+        file.seek(low - 1)
+        file.readline()
+        low = file.tell()
+    return low
+
 def make_fig_spikes2(
         spike_file: str,
         savedir: str='.',
@@ -23,12 +80,18 @@ def make_fig_spikes2(
         sizes=None,  # sizes of the markers for cue and non-cue spikes
         alpha=0.7,   # transparency of the markers, useful when there are a lot of spikes near each other, set to one if there are very few spikes and you want to clearly see them
         legend=False,
-        ax=None
+        ax=None,
+        density=None,  # draw a 2D histogram of the spikes instead of every spike, None means only above density_threshold spikes
+        density_threshold: int=200_000,
+        time_bins: int=1000,  # number of time bins of the 2D histogram
+        neuron_bins: int=1000  # largest number of neuron bins of the 2D histogram (one per neuron if there are fewer neurons)
         ):
     """
     This function plot a rasterplot starting from a spikes3 file of a simulation.
     The plot can be done in an ax of a matplotlib figure by passing the ax.
     There are a lot of graphical parameters.
+    With a lot of spikes the plot is made as an image of the number of spikes in each (time bin, neuron),
+    separately for cue and non-cue spikes, which takes about the same time whatever the number of spikes.
     """
     
     Zeta = 300
@@ -58,9 +121,13 @@ def make_fig_spikes2(
     # read the file
     file_type = os.path.splitext(spike_file)[1]
     if file_type == '.dat':
-        spikes_df = pd.read_csv(spike_file, sep="\s+", header=None)
+        # read only the spikes in the time window
+        spikes_df = read_spikes(spike_file, time_ini=time_ini, time_fin=time_fin)
     elif file_type == '.feather':
         spikes_df = pd.read_feather(spike_file)
+    elif file_type == store_extension:
+        # binary store made with spike_store.convert_spikes, only the time window is mapped in memory
+        spikes_df = read_spike_store(spike_file, time_ini=time_ini, time_fin=time_fin)
     else:
         print("Invalid file type")
         sys.exit(1)
@@ -78,7 +145,7 @@ def make_fig_spikes2(
     spike_times = df_filtered['time']
     neuron_ids = df_filtered[str(pattern)]
     num = df_filtered.shape[0]
-    greatest_neuron = np.max(neuron_ids)
+    greatest_neuron = int(np.max(neuron_ids))  # int because the neurons may be unsigned
     num_zones = greatest_neuron // Kappa
     t_max = np.max(spike_times)
 
@@ -94,12 +161,18 @@ def make_fig_spikes2(
             ax.axhspan(Kappa+i*Zeta, Zeta+i*Zeta, color='purple', alpha=0.1)
         ax.axhline(y=i*Zeta, color=colors["purple"], linestyle='--', linewidth=1, zorder=3)
         # ax.axhline(y=Kappa+i*Zeta, color='g', linestyle=':')
-    # Define the color map and sizes
-    colors = ListedColormap(['blue', 'red'])
-    if not sizes:
-        sizes = [10, 25]
-    sizes_list = [sizes[val] for val in df_filtered['cue']]
-    scatter = ax.scatter(spike_times, neuron_ids, c=df_filtered['cue'], cmap=colors, s=sizes_list, alpha=alpha, edgecolors=None, marker='|', zorder=4)
+    if density is None:
+        density = num > density_threshold
+    if density:
+        plot_spike_density(ax, spike_times, neuron_ids, df_filtered['cue'], time_ini=time_ini, t_max=t_max,
+                           greatest_neuron=greatest_neuron, time_bins=time_bins, neuron_bins=neuron_bins, alpha=alpha)
+    else:
+        # Define the color map and sizes
+        colors = ListedColormap(['blue', 'red'])
+        if not sizes:
+            sizes = [10, 25]
+        sizes_list = np.asarray(sizes)[df_filtered['cue'].to_numpy(dtype=np.int64)]
+        scatter = ax.scatter(spike_times, neuron_ids, c=df_filtered['cue'], cmap=colors, s=sizes_list, alpha=alpha, edgecolors=None, marker='|', zorder=4)
     # Set limits for x and y axes
     ax.set_xlim(time_ini, t_max * 105 // 100)
     ax.set_ylim(-greatest_neuron * 5 // 100, greatest_neuron * 105 // 100)
@@ -134,6 +207,122 @@ def make_fig_spikes2(
         plt.show()
         
 
+def plot_spike_density(ax, spike_times, neuron_ids, cue, time_ini, t_max, greatest_neuron, time_bins=1000, neuron_bins=1000, alpha=0.7):
+    """
+    Draws the spikes in ax as two images (non-cue in blue, cue in red on top) with the number of spikes in each (time bin, neuron bin).
+    There is one neuron bin per neuron up to neuron_bins neurons, then the neurons are grouped: the images are at most
+    neuron_bins x time_bins (about the pixels of the figure), also for networks with hundreds of thousands of neurons.
+    Bins with no spikes are transparent.
+    """
+    number_neurons = greatest_neuron + 1
+    neuron_bins = min(number_neurons, neuron_bins)
+    is_cue = np.asarray(cue, dtype=bool)
+    spike_times = np.asarray(spike_times, dtype=np.float64)
+    neuron_ids = np.asarray(neuron_ids, dtype=np.int64)
+
+    # bin of every spike, the spikes outside [time_ini, t_max] are not drawn
+    inside = (spike_times >= time_ini) & (spike_times <= t_max)
+    time_start, time_end = time_ini, t_max
+    if t_max > time_ini:
+        time_index = np.minimum(((spike_times[inside] - time_ini) * (time_bins / (t_max - time_ini))).astype(np.int64), time_bins - 1)
+    else:
+        # a window of a single instant: one time bin, one time unit wide around it
+        time_bins = 1
+        time_start, time_end = time_ini - 0.5, time_ini + 0.5
+        time_index = np.zeros(inside.sum(), dtype=np.int64)
+    neuron_index = neuron_ids[inside] * neuron_bins // number_neurons
+    flat_index = neuron_index * time_bins + time_index
+
+    for selection, color in [(~is_cue[inside], 'blue'), (is_cue[inside], 'red')]:
+        counts = np.bincount(flat_index[selection], minlength=neuron_bins * time_bins).reshape(neuron_bins, time_bins)
+        if not counts.any():
+            continue
+        # from transparent to the color of the spikes
+        cmap = LinearSegmentedColormap.from_list(f'density_{color}', [(0, 0, 0, 0), color])
+        ax.imshow(np.ma.masked_equal(counts, 0), cmap=cmap, vmin=0, vmax=counts.max(), alpha=alpha,
+                  extent=(time_start, time_end, -0.5, number_neurons - 0.5),
+                  origin='lower', aspect='auto', interpolation='nearest', zorder=4)
+
+def find_spike_files(simulation_dir: str, directories_matching_pattern: str=r'P-([\d\.]+)--range-([\d\.]+)') -> pd.DataFrame:
+    """
+    Finds all the spikes3 .dat files in the directories of a simulation (named like "P-500--range-4.0").
+    Returns a dataframe with P, range, sigma, delta, alpha (from the name of the file "spikes3-sigma-delta-alpha.dat") and the path.
+    """
+    catalog = build_catalog(simulation_dir, directories_matching_pattern=directories_matching_pattern)
+    # only the files with sigma, delta and alpha in the name (not the .spk stores), as in q3merge.merge_time_series
+    spike_files = files_of_kind(catalog, 'spikes3').dropna(subset=['sigma'])
+    spike_files = spike_files.rename(columns={'path': 'spike_file'})
+    return spike_files[['P', 'range', 'sigma', 'delta', 'alpha', 'spike_file']].reset_index(drop=True)
+
+def make_all_rasters(
+        simulation_dir: str,
+        savedir: str=None,
+        save_as: str='png',
+        workers: int=None,
+        force: bool=False,
+        directories_matching_pattern: str=r'P-([\d\.]+)--range-([\d\.]+)',
+        **kwargs
+        ) -> pd.DataFrame:
+    """
+    Makes the rasterplot of every spikes3 file of a simulation with make_fig_spikes2 (kwargs are passed to it),
+    in a pool of 'workers' processes (default: all the cores) with a non-interactive backend.
+    Figures that are newer than their spikes3 file are skipped, unless force is True.
+    The figures are saved in savedir (default: a "rasters" folder in the simulation directory) together with
+    an index "rasters-index.csv" with the parameters of each run, the figure and what happened to it.
+    """
+    if savedir is None:
+        savedir = os.path.join(simulation_dir, 'rasters')
+    os.makedirs(savedir, exist_ok=True)
+
+    jobs = find_spike_files(simulation_dir, directories_matching_pattern=directories_matching_pattern)
+    jobs['figure'] = [
+        os.path.join(savedir, f"raster_P-{row.P}_range-{row.range}_{os.path.splitext(os.path.basename(row.spike_file))[0]}.{save_as}")
+        for row in jobs.itertuples()
+    ]
+    print(f"{jobs.shape[0]} spikes3 files found in {simulation_dir}")
+
+    # only the figures that are missing or older than the spikes
+    to_render = [
+        force or not os.path.isfile(figure) or os.path.getmtime(figure) < os.path.getmtime(spike_file)
+        for spike_file, figure in zip(jobs['spike_file'], jobs['figure'])
+    ]
+    arguments = [(spike_file, figure, save_as, kwargs) for spike_file, figure, render in zip(jobs['spike_file'], jobs['figure'], to_render) if render]
+
+    statuses = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=plt.switch_backend, initargs=('Agg',)) as executor:
+        results = executor.map(render_raster, arguments)
+        for render in to_render:
+            statuses.append(next(results) if render else ('up to date', 0.0))
+    jobs['status'] = [status for status, _ in statuses]
+    jobs['seconds'] = [seconds for _, seconds in statuses]
+
+    jobs.to_csv(os.path.join(savedir, 'rasters-index.csv'), index=False)
+    print(jobs['status'].value_counts().to_string())
+    return jobs
+
+def render_raster(arguments):
+    """
+    Makes and saves a single rasterplot, used by make_all_rasters in the worker processes.
+    Returns the status ('rendered' or the error) and the time it took.
+    """
+    spike_file, figure, save_as, kwargs = arguments
+    time_start = time.perf_counter()
+    kwargs = dict(kwargs)
+    fig, ax = plt.subplots(figsize=kwargs.pop('figsize', (16, 10)))
+    try:
+        make_fig_spikes2(spike_file=spike_file, ax=ax, **kwargs)
+        fig.savefig(figure, format=save_as)
+        status = 'rendered'
+    except Exception as error:
+        status = f'failed: {error!r}'
+        print(purple(f"{spike_file}: {status}"))
+    finally:
+        plt.close(fig)
+    return status, time.perf_counter() - time_start
+
+def purple(string: str):
+    return "\033[95m" + string + "\033[0m"
+
 if __name__ == "__main__":
     dir = r'/path/of/your/spikes3/file.dat'
     make_fig_spikes2(spike_file=dir)
\ No newline at end of file
@@ -1,8 +1,18 @@
 import os
 import re
+import sys
+import shutil
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor
 
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+from catalog import build_catalog, file_kind, files_of_kind, find_connessioni_files
+from dat_reader import read_dat, read_dat_df
 
 # ! PARAMETERS TO CHANGE EVERY TIME
 
@@ -11,6 +21,12 @@ simulation_name = r'example_simulation'
 
 pout = 20
 max_lines = 30  #* sarebbe tmax / flush
+workers = 1  #* number of processes used to read the q3 files
+incremental = False  #* read again only the q3 files that changed since the last merge
+time_series = True  #* also merge the medie3, temp3 and rate3 files (merge_time_series)
+compact = True  #* save with smaller dtypes (see compact_dtypes), the merged files take about half the memory
+shard = None  #* "3/16" merges only the run directories of the shard 3 of 16 (see merge_shard), "reduce" joins the shards (also from the command line: python q3merge.py 3/16)
+instrument = False  #* print the time of every function at the end and save it in {output_name}-profile.json (see instrumentation.py)
 
 #
 # general_dir = r'/home/apicella/Output_Files/'
@@ -22,106 +38,469 @@ output_name = r'q3-' + simulation_name
 # 
 simulation_dir = os.path.join(general_dir, simulation_name)
 savedir = os.path.join(simulation_dir, output_name)
+manifest_path = savedir + '-manifest.csv'
+
+# kinds of files merged by merge_time_series, and the columns of medie3 and temp3 (see the output files of the runs)
+time_series_kinds = ['medie3', 'temp3', 'rate3']
+temp3_columns = ['sigma', 'delta', 'alpha', 'time', 'rate', 'variance', 'cv', 'fano']
 
-def merge_all_q3_files(out_format='.feather'):
+# partitioning of the '.parquet' output
+partitioning = ds.partitioning(pa.schema([('P', pa.int64()), ('range', pa.float64())]), flavor='hive')
+
+def merge_all_q3_files(out_format='.feather', workers=1, incremental=False, compact=compact):
     """
     Merges all q3 files in a simulation directory and creates a unique feather file to be easily read.
+    The files are parsed in a pool of 'workers' processes (1 means no pool) and concatenated only once at the end,
+    so the merge time grows linearly with the number of files.
+    A manifest with path, size, modification time and number of rows of every q3 file is saved next to the output.
+    With incremental=True only the files that are new or changed since the last merge are read again,
+    the rows of the others are taken from the previous output (and the rows of deleted files are dropped).
+    out_format='.parquet' writes a dataset partitioned by P and range that the Simulation class reads lazily.
+    With compact=True the columns are saved with the dtypes of compact_dtypes.
     """
 
     print(f"Out format = {out_format}.")
 
-    first_iteration = True
-
-    # Loop through the directories and files
-    for entry in os.listdir(simulation_dir):
-        full_path = os.path.join(simulation_dir, entry)
-        
-        if os.path.isdir(full_path):
-            # Extract P and range:
-            try:
-                number_patterns, mixing_range = extract_numbers(entry)
-                print(f'dir = {entry}: P={number_patterns}, range={mixing_range}')
-            except ValueError:
-                print(f'dir = {entry}: not counted')
-                continue
-
-            for filename in os.listdir(full_path):
-                # Select only q3 files:
-                if filename[:2] == 'q3':    
-                    q3_filepath = os.path.join(full_path, filename)
-                    q3_file_df = pd.read_csv(q3_filepath, sep='\s+', header=None)
-                    q3_file_df = format_df(q3_file_df, number_patterns=number_patterns, mixing_range=mixing_range)
-
-                    # create df variable on first file
-                    if first_iteration:
-                        df = q3_file_df
-                        first_iteration = False
-                    # add to the df variable
-                    else:
-                        df = pd.concat([df, q3_file_df], ignore_index=True)
+    # Find all the q3 files (in the same order as os.listdir, so that the output does not change)
+    time_start = time.perf_counter()
+    q3_catalog = find_q3_files()
+    q3_files = list(zip(q3_catalog['path'], q3_catalog['P'].tolist(), q3_catalog['range'].tolist()))
+    manifest = make_manifest(q3_catalog)
+    time_find = time.perf_counter()
+
+    if not q3_files:
+        raise ValueError(purple(f"No q3 file found in {simulation_dir}"))
+
+    # Take the rows of unchanged files from the previous output
+    old_dfs = {}
+    if incremental:
+        old_manifest = read_manifest()
+        if old_manifest is not None and os.path.exists(savedir + out_format):
+            if old_manifest[['path', 'size', 'mtime']].equals(manifest[['path', 'size', 'mtime']]):
+                print(f"{len(q3_files)} q3 files, nothing changed since the last merge ({time.perf_counter() - time_start:.3f} s)")
+                print("I am done")
+                return
+            old_dfs = split_merged_file(old_manifest, manifest, out_format)
+    time_old = time.perf_counter()
+
+    # Read and format every file that is not in the previous output, in parallel if requested
+    to_read = [q3_file for q3_file in q3_files if q3_file[0] not in old_dfs]
+    new_dfs = dict(zip([q3_file[0] for q3_file in to_read], read_q3_files(to_read, workers=workers)))
+    time_read = time.perf_counter()
+
+    # a single concat instead of one for each file
+    q3_file_dfs = [old_dfs[path] if path in old_dfs else new_dfs[path] for path in manifest['path']]
+    manifest['rows'] = [q3_file_df.shape[0] for q3_file_df in q3_file_dfs]
+    df = pd.concat(q3_file_dfs, ignore_index=True)
+    if compact:
+        df = compact_dtypes(df)
+    time_concat = time.perf_counter()
 
     # save the file
+    save_merged(df, savedir, out_format)
+    manifest.to_csv(manifest_path, index=False)
+    time_save = time.perf_counter()
+
+    print(f"{len(q3_files)} q3 files ({len(to_read)} read, {len(old_dfs)} from the previous output), workers = {workers}")
+    print(f"\tfind files: {time_find - time_start:.3f} s")
+    if incremental:
+        print(f"\tread previous output: {time_old - time_find:.3f} s")
+    print(f"\tread and format: {time_read - time_old:.3f} s")
+    print(f"\tconcat: {time_concat - time_read:.3f} s")
+    print(f"\tsave: {time_save - time_concat:.3f} s")
+    print("I am done")
+
+def compact_dtypes(df, verbose=True):
+    """
+    Returns a merged dataframe with smaller dtypes:
+      - P and range categorical (a small code for each row, the values are the same),
+      - line int16 (int32 if it does not fit),
+      - sigma, delta and alpha float64 (they are compared with the values of the parameters, so they stay exact),
+      - all the other columns float32, also '# spike' and 'which_max': they are NaN in the rows added by format_df
+        and float32 is exact for integers up to 2**24.
+    Works also with the dataframes of merge_time_series and with dataframes that are already compact.
+    """
+    memory_before = df.memory_usage(deep=True).sum()
+    dtypes = {}
+    for column in df.columns:
+        if column in ('sigma', 'delta', 'alpha'):
+            dtypes[column] = np.float64
+        elif column == 'P':
+            dtypes[column] = pd.CategoricalDtype(np.sort(df[column].astype(np.int64).unique()))
+        elif column == 'range':
+            dtypes[column] = pd.CategoricalDtype(np.sort(df[column].astype(np.float64).unique()))
+        elif column == 'line':
+            dtypes[column] = np.int16 if df[column].max() <= np.iinfo(np.int16).max else np.int32
+        else:
+            dtypes[column] = np.float32
+    # categorical from plain numbers, so the categories are numbers also when the old rows were already categorical
+    df = df.astype({'P': np.int64, 'range': np.float64} if 'P' in df.columns else {}).astype(dtypes)
+
+    if verbose:
+        memory_after = df.memory_usage(deep=True).sum()
+        print(f"\tmemory: {memory_before / 1e6:.1f} MB -> {memory_after / 1e6:.1f} MB")
+    return df
+
+def merge_time_series(kinds=time_series_kinds, out_format='.feather', workers=1, compact=compact):
+    """
+    Merges the medie3, temp3 and rate3 files of all the runs, like merge_all_q3_files does with the q3 files:
+    one file "{kind}-{simulation_name}" (with the extension of out_format) for each kind in the simulation directory.
+    medie3 and temp3 have the columns temp3_columns, rate3 has 'time' and 'rate site 0', 'rate site 1', ... and also
+    sigma, delta and alpha from the name of the file; all of them get P and range.
+    The '-nan' written by the simulations (for example the CV of a window without spikes) become NaN.
+    With compact=True the columns are saved with the dtypes of compact_dtypes.
+    """
+    catalog = build_catalog(simulation_dir, directories_matching_pattern=directories_matching_pattern, save=True)
+
+    for kind in kinds:
+        time_start = time.perf_counter()
+        # only the files with sigma, delta and alpha in the name, like "temp3-5.5-0-0.5.dat"
+        files = files_of_kind(catalog, kind).dropna(subset=['sigma'])
+        if files.empty:
+            print(purple(f"No {kind} file found in {simulation_dir}"))
+            continue
+        time_series_files = list(zip(
+            files['path'], files['P'].tolist(), files['range'].tolist(),
+            files['sigma'].tolist(), files['delta'].tolist(), files['alpha'].tolist(), [kind] * files.shape[0]
+        ))
+
+        if workers > 1 and len(time_series_files) > 1:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                dfs = list(executor.map(read_time_series_file, time_series_files, chunksize=max(1, len(time_series_files) // (4 * workers))))
+        else:
+            dfs = [read_time_series_file(time_series_file) for time_series_file in time_series_files]
+        df = pd.concat(dfs, ignore_index=True)
+        if compact:
+            df = compact_dtypes(df)
+
+        save_merged(df, os.path.join(simulation_dir, f'{kind}-{simulation_name}'), out_format)
+        print(f"{kind}: {len(time_series_files)} files, {df.shape[0]} rows ({time.perf_counter() - time_start:.3f} s)")
+
+def read_time_series_file(time_series_file):
+    """
+    Reads a single medie3, temp3 or rate3 file, time_series_file is a tuple (path, P, range, sigma, delta, alpha, kind).
+    It is a top level function so that it can be sent to the worker processes.
+    """
+    path, number_patterns, mixing_range, sigma, delta, alpha, kind = time_series_file
+    values = read_dat(path)
+
+    if kind == 'rate3':
+        columns = ['time'] + [f'rate site {i}' for i in range(values.shape[1] - 1)]
+        df = pd.DataFrame(values, columns=columns)
+        df.insert(0, 'sigma', sigma)
+        df.insert(1, 'delta', delta)
+        df.insert(2, 'alpha', alpha)
+    else:
+        if values.shape[1] != len(temp3_columns):
+            raise ValueError(purple(f"read_time_series_file: {path} has {values.shape[1]} columns instead of {len(temp3_columns)}"))
+        df = pd.DataFrame(values, columns=temp3_columns)
+
+    df['P'] = np.int64(number_patterns)
+    df['range'] = float(mixing_range)
+    return df
+
+def merge_shard(shard_index=0, number_shards=1, run_dirs=None, shard_name=None, workers=1, compact=compact):
+    """
+    Map step of a merge spread over many nodes: merges only the q3 files of the run directories of one shard into a
+    partial file "{output_name}-shards/{shard_name}.feather", with its manifest next to it; reduce_shards makes the
+    merged output from all the partials.
+    The run directories of the shard are the ones with shard_of(name, number_shards) == shard_index, or the ones in
+    run_dirs (names or paths) if it is given. Only these directories are listed, the catalog is not made (or saved),
+    so the nodes never write the same file. The shard name is "shard-{shard_index}-of-{number_shards}" by default.
+    Returns the path of the partial file, None if the shard has no q3 file.
+    """
+    time_start = time.perf_counter()
+    if run_dirs is not None:
+        run_dirs = {os.path.basename(os.path.normpath(run_dir)) for run_dir in run_dirs}
+        if shard_name is None:
+            raise ValueError(purple("merge_shard: give a shard_name to the shard made of the run_dirs"))
+    elif not 0 <= shard_index < number_shards:
+        raise ValueError(purple(f"merge_shard: shard_index must be between 0 and {number_shards - 1}, not {shard_index}"))
+    if shard_name is None:
+        shard_name = f'shard-{shard_index}-of-{number_shards}'
+
+    # the q3 files of the shard, in the same order as in the catalog, with the columns of the catalog used by make_manifest
+    q3_rows = []
+    for entry in os.scandir(simulation_dir):
+        match = re.search(directories_matching_pattern, entry.name)
+        if not match or not entry.is_dir():
+            continue
+        if (entry.name not in run_dirs) if run_dirs is not None else (shard_of(entry.name, number_shards) != shard_index):
+            continue
+        number_patterns, mixing_range = int(match.group(1)), float(match.group(2))
+        for file in os.scandir(entry.path):
+            if file.is_file() and file_kind(file.name)[0] == 'q3':
+                stat = file.stat()
+                q3_rows.append((file.path, number_patterns, mixing_range, stat.st_size, stat.st_mtime_ns))
+    q3_catalog = pd.DataFrame(q3_rows, columns=['path', 'P', 'range', 'size', 'mtime'])
+    q3_files = [q3_row[:3] for q3_row in q3_rows]
+    manifest = make_manifest(q3_catalog)
+    time_find = time.perf_counter()
+
+    if not q3_files:
+        print(purple(f"{shard_name}: no q3 file in the run directories of this shard"))
+        return None
+
+    q3_file_dfs = read_q3_files(q3_files, workers=workers)
+    manifest['rows'] = [q3_file_df.shape[0] for q3_file_df in q3_file_dfs]
+    df = pd.concat(q3_file_dfs, ignore_index=True)
+    if compact:
+        # P and range plain numbers (the categories of each shard are different) and line int32, so that all the
+        # partials have the same schema; reduce_shards makes them compact again
+        df = compact_dtypes(df, verbose=False).astype({'P': np.int64, 'range': np.float64, 'line': np.int32})
+    time_read = time.perf_counter()
+
+    shards_dir = savedir + '-shards'
+    os.makedirs(shards_dir, exist_ok=True)
+    partial_path = os.path.join(shards_dir, shard_name + '.feather')
+    df.to_feather(partial_path)
+    manifest.to_csv(os.path.join(shards_dir, shard_name + '-manifest.csv'), index=False)
+    time_save = time.perf_counter()
+
+    print(f"{shard_name}: {len(q3_files)} q3 files, {df.shape[0]} rows, workers = {workers}")
+    print(f"\tfind files: {time_find - time_start:.3f} s")
+    print(f"\tread and format: {time_read - time_find:.3f} s")
+    print(f"\tsave: {time_save - time_read:.3f} s")
+    return partial_path
+
+def reduce_shards(out_format='.feather', compact=compact):
+    """
+    Reduce step of the sharded merge: joins the partial files made by merge_shard into the merged output and its
+    manifest, the same ones that merge_all_q3_files would make (so also the incremental merge works after it).
+    The partials are read as Arrow tables and their blocks are put in the order of the run directories without
+    copying them, no q3 file is read again. It stops if a run directory is in more than one partial (old partials
+    of a different sharding must be deleted) and it warns about the run directories that are in none.
+    """
+    import pyarrow.feather as feather
+
+    time_start = time.perf_counter()
+    shards_dir = savedir + '-shards'
+    manifest_suffix = '-manifest.csv'
+    shard_names = sorted(name[:-len(manifest_suffix)] for name in os.listdir(shards_dir) if name.endswith(manifest_suffix)) \
+        if os.path.isdir(shards_dir) else []
+    if not shard_names:
+        raise ValueError(purple(f"reduce_shards: no partial file in {shards_dir}, run merge_shard first"))
+
+    # {run directory name: (shard name, table of its rows, its rows of the manifest)}
+    blocks = {}
+    for shard_name in shard_names:
+        shard_manifest = pd.read_csv(os.path.join(shards_dir, shard_name + manifest_suffix),
+                                     dtype={'path': str, 'size': np.int64, 'mtime': np.int64, 'rows': np.int64})
+        table = feather.read_table(os.path.join(shards_dir, shard_name + '.feather'))
+        if shard_manifest['rows'].sum() != table.num_rows:
+            raise ValueError(purple(f"reduce_shards: {shard_name}.feather does not match its manifest, run merge_shard again"))
+        starts = shard_manifest['rows'].cumsum().to_numpy() - shard_manifest['rows'].to_numpy()
+        # the files of a run directory are contiguous, the directories are named as in the simulation directory
+        run_dir_names = shard_manifest['path'].map(lambda path: os.path.basename(os.path.dirname(path)))
+        for run_dir_name, rows in shard_manifest.groupby(run_dir_names, sort=False):
+            if run_dir_name in blocks:
+                raise ValueError(purple(f"reduce_shards: {run_dir_name} is in {blocks[run_dir_name][0]} and in {shard_name}, "
+                                        f"delete the old partials in {shards_dir}"))
+            start = starts[rows.index[0]]
+            blocks[run_dir_name] = (shard_name, table.slice(start, rows['rows'].sum()), rows)
+    time_read = time.perf_counter()
+
+    # the run directories in the order of os.listdir, as in merge_all_q3_files
+    run_dir_names = [entry.name for entry in os.scandir(simulation_dir)
+                     if re.search(directories_matching_pattern, entry.name) and entry.is_dir()]
+    missing = [run_dir_name for run_dir_name in run_dir_names if run_dir_name not in blocks]
+    if missing:
+        print(purple(f"reduce_shards: {len(missing)} run directories are in no partial (or have no q3 file): {', '.join(missing)}"))
+    order = [run_dir_name for run_dir_name in run_dir_names if run_dir_name in blocks]
+    order += [run_dir_name for run_dir_name in blocks if run_dir_name not in set(run_dir_names)]
+
+    try:
+        table = pa.concat_tables([blocks[run_dir_name][1] for run_dir_name in order])
+    except pa.ArrowInvalid:
+        raise ValueError(purple("reduce_shards: the partials have different columns or dtypes (made with and without compact?)"))
+    df = table.to_pandas()
+    if compact:
+        df = compact_dtypes(df)
+    manifest = pd.concat([blocks[run_dir_name][2] for run_dir_name in order], ignore_index=True)
+    time_concat = time.perf_counter()
+
+    save_merged(df, savedir, out_format)
+    manifest.to_csv(manifest_path, index=False)
+    time_save = time.perf_counter()
+
+    print(f"{len(shard_names)} partials, {manifest.shape[0]} q3 files, {df.shape[0]} rows")
+    print(f"\tread partials: {time_read - time_start:.3f} s")
+    print(f"\tconcat: {time_concat - time_read:.3f} s")
+    print(f"\tsave: {time_save - time_concat:.3f} s")
+    print("I am done")
+
+def shard_of(run_dir_name, number_shards):
+    """
+    Shard of a run directory, from its name only, so that every node gets the same answer
+    (the hash of python changes at every start of the interpreter, crc32 does not)
+    """
+    return zlib.crc32(run_dir_name.encode()) % number_shards
+
+def save_merged(df, path, out_format):
+    """
+    Saves a merged dataframe in path + out_format
+    """
     match(out_format):
         case '.feather':
-            df.to_feather(savedir + out_format)
+            df.to_feather(path + out_format)
         case '.csv':
-            df.to_csv(savedir + out_format, index=False)
+            df.to_csv(path + out_format, index=False)
+        case '.parquet':
+            write_partitioned_dataset(df, path + out_format)
         case _:
             raise ValueError(purple(f"Format {out_format} is not supported but you can easily add it to the code"))
-        
-    print("I am done")
 
-def format_df(df, number_patterns, mixing_range):
+def write_partitioned_dataset(df, path):
+    """
+    Writes the merged dataframe as a parquet dataset partitioned by P and range (folders like "P=10/range=2.0"),
+    so that a single (P, range) couple can be read without reading the rest.
+    The previous dataset, if any, is deleted.
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    # the partition columns are plain numbers (also when compact_dtypes made them categorical)
+    df = df.astype({'P': np.int64, 'range': np.float64})
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    ds.write_dataset(table, path, format='parquet', partitioning=partitioning, basename_template='part-{i}.parquet')
+
+def read_q3_files(q3_files, workers=1):
+    """
+    Reads and formats a list of q3 files (tuples (path, P, range) of the rows of find_q3_files), in a pool of processes if workers > 1.
+    Returns the list of dataframes in the same order.
+    """
+    if workers > 1 and len(q3_files) > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(read_q3_file, q3_files, chunksize=max(1, len(q3_files) // (4 * workers))))
+    return [read_q3_file(q3_file) for q3_file in q3_files]
+
+def make_manifest(q3_catalog):
+    """
+    Returns a dataframe with path, size and modification time (in ns) of the q3 files, taken from their rows of the
+    catalog (the files are not stat-ed again).
+    The number of rows of each file in the merged output is added after the merge.
+    """
+    return q3_catalog[['path', 'size', 'mtime']].reset_index(drop=True)
+
+def read_manifest():
+    """
+    Reads the manifest of the previous merge, returns None if there is none
+    """
+    if not os.path.isfile(manifest_path):
+        return None
+    return pd.read_csv(manifest_path, dtype={'path': str, 'size': np.int64, 'mtime': np.int64, 'rows': np.int64})
+
+def split_merged_file(old_manifest, manifest, out_format):
+    """
+    Reads the previous merged output and splits it in one dataframe for each q3 file that did not change.
+    Returns a dictionary {path: dataframe}.
+    """
+    match(out_format):
+        case '.feather':
+            old_df = pd.read_feather(savedir + out_format)
+        case '.csv':
+            old_df = pd.read_csv(savedir + out_format)
+        case '.parquet':
+            # the rows are grouped by partition, so they can not be matched to the files of the manifest
+            print(purple("The incremental merge does not work with the partitioned dataset, all files will be read again"))
+            return {}
+        case _:
+            raise ValueError(purple(f"Format {out_format} is not supported but you can easily add it to the code"))
+
+    # the rows of each file are contiguous and in the order of the manifest
+    if old_manifest['rows'].sum() != old_df.shape[0]:
+        print(purple("The previous output does not match its manifest, all files will be read again"))
+        return {}
+    ends = old_manifest['rows'].cumsum().to_numpy()
+    starts = ends - old_manifest['rows'].to_numpy()
+
+    unchanged = old_manifest.merge(manifest, on=['path', 'size', 'mtime'], how='inner')['path']
+    unchanged = set(unchanged)
+    return {
+        path: old_df.iloc[start:end]
+        for path, start, end in zip(old_manifest['path'], starts, ends)
+        if path in unchanged
+    }
+
+def find_q3_files():
+    """
+    Returns the rows of the catalog (P, range, path, size, mtime, ...) of all the q3 files in the simulation directory
+    """
+    # all the files are in the catalog of the simulation, made with a single walk of the directories.
+    # It is made again (refresh) because the manifest needs the current size and mtime of the q3 files, and appending to
+    # a file does not change the mtime of its directory; this is still one stat for every file, as before
+    catalog = build_catalog(simulation_dir, directories_matching_pattern=directories_matching_pattern, refresh=True, save=True)
+    for run_dir in files_of_kind(catalog, 'dir').itertuples():
+        print(f'dir = {os.path.basename(run_dir.path)}: P={run_dir.P}, range={run_dir.range}')
+
+    return files_of_kind(catalog, 'q3')
+
+def read_q3_file(q3_file):
+    """
+    Reads and formats a single q3 file, q3_file is a tuple (path, P, range) of a row of find_q3_files.
+    It is a top level function so that it can be sent to the worker processes.
+    """
+    q3_filepath, number_patterns, mixing_range = q3_file
+    q3_file_df = read_dat_df(q3_filepath, kind='q3')
+    return format_df(q3_file_df, number_patterns=number_patterns, mixing_range=mixing_range)
+
+def format_df(df, number_patterns, mixing_range, number_observed=None, number_lines=None):
     """
     This function takes a headerless df as input and adds the correct number of rows and colums by adding NaN values.
     This way one can merge dataframes from simulations with less patterns printed or
     simulations ended prematurely due to the maxsp2 mechanism.
     Also adds information like the line, the range and the number of patterns used in the simulation.
     24_11_19 adds also the rate of the last time window calculated as (#spikes)/(tmax-tmin)
+    The values are copied in a NaN array of the final shape, so there is no loop over the missing rows or columns.
+    number_observed and number_lines are pout and max_lines of the simulation, the globals of this file if None.
     """
+    number_observed = pout if number_observed is None else number_observed
+    number_lines = max_lines if number_lines is None else number_lines
+
+    values = df.to_numpy(dtype=np.float64)
+    number_rows, number_cols = values.shape
+    number_data_cols = 9 + 2 * number_observed
 
-    # Check if all values in the first three columns are equal using the `all()` method
-    conditions = [(df.iloc[:, column] == df.iloc[0, column]).all() for column in range(3)]
+    # Check if all values in the first three columns are equal
     # get sigma, delta, alpha if they are the same, raise error instead
-    if all(conditions):
-        sigma, delta, alpha = df.iloc[0, 0:3]
+    if (values[:, :3] == values[0, :3]).all():
+        sigma, delta, alpha = values[0, :3]
     else:
         raise ValueError(purple("\n\n\tformat_df: not all sigmas, deltas or alphas in the dataframe are equal!\n\n"))
 
-    number_rows, number_cols = df.shape
+    if number_rows > number_lines:
+        raise TypeError(purple(f"\n\n\tformat_df: numebr of rows ({number_rows}) is greater than max lines ({number_lines})!\n\n"))
+    if number_cols > number_data_cols:
+        raise TypeError(purple(f"\n\n\tformat_df: number of columns ({number_cols}) is greater than 9 + 2 * pout ({number_data_cols})!\n\n"))
 
-    # get the right number of rows by putting NaN values in
-    if number_rows > max_lines:
-        raise TypeError(purple(f"\n\n\tformat_df: numebr of rows ({number_rows}) is greater than max lines ({max_lines})!\n\n"))
-    elif number_rows < max_lines:
-        # cycle until you get to max_lines lines
-        while df.shape[0] < max_lines:
-            # sigma, delta and alpha need to be correct
-            new_row = np.array([sigma, delta, alpha] + [np.nan for _ in range(number_cols-3)])
-            new_row_df = pd.DataFrame([new_row])
-            df = pd.concat([df, new_row_df], ignore_index=True)
+    # preallocate the final array (data columns + P, range, line, rate) full of NaN and copy the values in
+    formatted = np.full((number_lines, number_data_cols + 4), np.nan)
+    formatted[:number_rows, :number_cols] = values
 
-    # get the right number of columns by putting NaN values in    
-    while df.shape[1] < (9 + 2 * pout):
-        df[len(df.columns)] = np.full(max_lines, np.nan)
+    # sigma, delta and alpha need to be correct also in the added rows
+    formatted[number_rows:, 0:3] = (sigma, delta, alpha)
 
     # add range and P columns
-    df[len(df.columns)] = np.full(max_lines, number_patterns)
-    df[len(df.columns)] = np.full(max_lines, mixing_range)
+    formatted[:, number_data_cols] = number_patterns
+    formatted[:, number_data_cols + 1] = mixing_range
 
     # add line-number columns (reverse the order, 1 is the last one and so on)
-    df[len(df.columns)] = np.arange(max_lines, 0, -1)
+    formatted[:, number_data_cols + 2] = np.arange(number_lines, 0, -1)
+
+    # add a rate column
+    with np.errstate(divide='ignore', invalid='ignore'):  # same as pandas, tmax == tmin gives inf or NaN
+        formatted[:, number_data_cols + 3] = formatted[:, 5] / (formatted[:, 4] - formatted[:, 3])
 
     # create the column names
     cols = ['sigma','delta','alpha','tmin','tmax','# spike','which_max','max overlap','fluctuations']
-    for i in range(pout):
+    for i in range(number_observed):
         cols.append(f'window pattern {i}')
         cols.append(f'overlap pattern {i}')
-    cols += ['P', 'range', 'line']
-    df.columns = cols
+    cols += ['P', 'range', 'line', 'rate']
 
-    # add a rate column
-    df['rate'] = df['# spike'] / (df['tmax'] - df['tmin'])
+    df = pd.DataFrame(formatted, columns=cols)
+    # P and line are integers
+    df['P'] = df['P'].astype(np.int64)
+    df['line'] = df['line'].astype(np.int64)
 
     return df
 
@@ -145,42 +524,8 @@ def extract_connessioni_file():
     """
     Finds and returns in a dataframe all the directories of the files CONNESSIONI
     """
-    # Create empty  dataframe
-    df_connessioni = pd.DataFrame(columns=['P', 'range', 'connessioni_file'])
-
-    # Create a regular expression pattern for files starting with 'CONNESSIONI'
-    pattern = r'^CONNESSIONI.*'
-
-    for entry in os.listdir(simulation_dir):
-        full_path = os.path.join(simulation_dir, entry)
-        
-        if os.path.isdir(full_path):
-            # Extract P and range:
-            try:
-                number_patterns, mixing_range = extract_numbers(entry)
-                files = os.listdir(full_path)
-                # Filter the files based on the pattern using re.match
-                matching_files = [f for f in files if re.match(pattern, f)]
-                # Get the full paths of the matching files
-                matching_file_paths = [os.path.join(full_path, f) for f in matching_files]
-
-                # Check if exactly one file matches the pattern
-                if len(matching_file_paths) == 1:
-                    # Add the found file path to the dataframe
-                    new_row = {'P': number_patterns, 'range': mixing_range, 'connessioni_file':matching_file_paths[0]}
-                    df_connessioni.loc[len(df_connessioni)] = new_row
-                    print(f'dir = {entry}: P={number_patterns}, range={mixing_range}, single file CONNESSIONI found')
-                else:
-                    if len(matching_file_paths) == 0:
-                        print(purple("No file starting with 'CONNESSIONI' was found."))
-                    else:
-                        print(purple("Multiple files starting with 'CONNESSIONI' were found."))
-
-            except ValueError:
-                print(f'dir = {entry}: not counted')
-    
-    # Return the dataframe
-    return df_connessioni
+    catalog = build_catalog(simulation_dir, directories_matching_pattern=directories_matching_pattern)
+    return find_connessioni_files(catalog, verbose=True)
 
 def purple(string: str):
     return "\033[95m" + string + "\033[0m"
@@ -194,5 +539,23 @@ def test():
 
 if __name__ == "__main__":
     # test()
-    merge_all_q3_files()
+    if instrument:
+        import instrumentation
+        # the functions called below are looked up in this module, which is __main__ and not q3merge
+        instrumentation.enable(targets=[sys.modules[__name__]])
+    if len(sys.argv) > 1:
+        shard = sys.argv[1]
+    if shard is None:
+        merge_all_q3_files(workers=workers, incremental=incremental, compact=compact)
+    elif shard == 'reduce':
+        reduce_shards(compact=compact)
+    else:
+        # each node merges its shard, then one of them runs "python q3merge.py reduce"
+        shard_index, number_shards = (int(number) for number in shard.split('/'))
+        merge_shard(shard_index, number_shards, workers=workers, compact=compact)
+    if time_series and shard is None:
+        merge_time_series(workers=workers, compact=compact)
+    if instrument:
+        instrumentation.report()
+        instrumentation.export(savedir + '-profile.json')
     # merge_all_q3_files(out_format='.csv')
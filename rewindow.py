@@ -0,0 +1,294 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+from spike_store import iter_spike_chunks
+from dat_reader import read_dat, read_run_parameters
+from catalog import build_catalog, files_of_kind, file_kind
+
+# Recalculates the q3 columns (# spike, which_max, max overlap, fluctuations, window and overlap of each pattern)
+# from the spikes3 files, with any time window and step, without running the simulation again.
+#
+# The overlap of the window [tmin, tmax] with the pattern mu is the one of the C code:
+#     max over T of | sum over the spikes s of the neurons of the pattern of exp(i * (2 pi t_s / T - phi^mu_s)) | / (number of spikes in the window)
+# where phi^mu_s is the phase in the pattern mu of the neuron that made the spike s (from the PATTERN file, the spikes
+# of the neurons that are not in the pattern count only in the denominator) and T goes from 10 to twin ms in steps of 5 ms.
+# The 'window' of each pattern is the first T with the maximum (0 if no neuron of the pattern spiked, as the overlap);
+# when the pattern has a single spike in the window every T gives the same overlap and the C code may write another T.
+# As in the C code, tmax is the time of the last spike before the end of the window and, with the windows of the q3
+# files (window=None), the overlaps are 0 until tmax - tmin is at least fmin * twin.
+# 'fluctuations' is the variance of 'max overlap' on the last n_fluctuations windows (flush2 in the simulations),
+# counting as 0 the windows of the simulation before tmin.
+# The C code is not in this folder: check_simulation compares the result with the q3 files at the windows of the
+# simulation, on example_simulation all the columns are the same within 1e-6 (tmax within the 6 digits of the files).
+
+directories_matching_pattern = r'P-([\d\.]+)--range-([\d\.]+)'  #! should contain P and range
+
+def q3_columns(pout: int) -> list:
+    """
+    Names of the columns of the merged q3 dataframe (same as q3merge.format_df)
+    """
+    cols = ['sigma','delta','alpha','tmin','tmax','# spike','which_max','max overlap','fluctuations']
+    for i in range(pout):
+        cols.append(f'window pattern {i}')
+        cols.append(f'overlap pattern {i}')
+    return cols + ['P', 'range', 'line', 'rate']
+
+def read_pattern_phases(pattern_file: str, number_patterns: int, number_neurons: int) -> np.ndarray:
+    """
+    Returns the phases of the PATTERN file as an array (number_patterns, number_neurons):
+    phases[mu, n] is the phase of the neuron n (the neuron written in the spikes3 files) in the pattern mu,
+    NaN if the neuron is not in the pattern.
+    The PATTERN file has number_patterns lines with the order of the sites, one line with the size of the patterns,
+    number_patterns lines with the neurons of the patterns (in the order of their phases) and number_patterns lines
+    with the phases; after the size of the pattern the lines are padded with zeros.
+    """
+    with open(pattern_file) as file:
+        lines = [line for line in file.read().split('\n') if line.strip()]
+    sizes = np.array(lines[number_patterns].split(), dtype=np.int64)
+    neurons = np.array([line.split() for line in lines[number_patterns + 1:2 * number_patterns + 1]], dtype=np.int64)
+    pattern_phases = np.array([line.split() for line in lines[2 * number_patterns + 1:3 * number_patterns + 1]], dtype=np.float64)
+
+    phases = np.full((number_patterns, number_neurons), np.nan)
+    for mu in range(number_patterns):
+        size = sizes[mu % sizes.shape[0]]
+        phases[mu, neurons[mu, :size]] = pattern_phases[mu, :size]
+    return phases
+
+def rewindow_spike_file(
+        spike_file: str,
+        pattern_file: str,
+        output_file: str,
+        number_patterns: int,
+        mixing_range: float,
+        window: float=None,
+        step: float=10,
+        time_ini: float=None,
+        time_fin: float=None,
+        periods: np.ndarray=None,
+        n_fluctuations: int=None,
+        pout: int=20,
+        chunksize: int=1_000_000
+        ) -> pd.DataFrame:
+    """
+    Recalculates the q3 dataframe of a single run from its spikes3 file, with windows that end every 'step' ms.
+    With window=None the windows all start at time_ini (like the q3 files, where tmin is fixed), otherwise they are
+    sliding windows [tmax - window, tmax].
+    time_ini, time_fin and n_fluctuations default to tmin, tmax and flush2 of the output file of the run,
+    periods (the values of T, see the top of this file) to 10, 15, ... twin ms.
+    With window=None and step=flush the result is the same as the q3 file of the run (see check_simulation).
+    The spike file is read in chunks: for each chunk only the cumulative sums at the limits of the windows are kept,
+    so the memory does not depend on the size of the file.
+    Returns a dataframe with the same columns as the merged q3 file (line 1 is the last window).
+    """
+    parameters = read_run_parameters(output_file)
+    time_ini = float(parameters['tmin']) if time_ini is None else time_ini
+    time_fin = float(parameters['tmax']) if time_fin is None else time_fin
+    # twin and fmin of the simulations when the output file does not have them
+    longest_window = float(parameters.get('twin', 200))
+    shortest_fraction = float(parameters.get('fmin', 0.5))
+    periods = np.arange(10, longest_window + 1, 5) if periods is None else np.asarray(periods, dtype=np.float64)
+    n_fluctuations = int(parameters['flush2']) if n_fluctuations is None else n_fluctuations
+    max_spikes = min(int(parameters.get('maxsp', np.iinfo(np.int64).max)), int(parameters.get('maxsp2', np.iinfo(np.int64).max)))
+    number_neurons = int(parameters['S']) * int(parameters['Z'])
+
+    _, sigma, delta, alpha = file_kind(os.path.basename(spike_file))
+
+    # limits of the windows
+    ends = np.arange(time_ini + (window or step), time_fin + step / 1000, step)
+    starts = ends - window if window else np.full(ends.shape, time_ini)
+    edges = np.concatenate([starts, ends])
+
+    observed = min(number_patterns, pout)
+    # exp(-i phi) of every neuron in the observed patterns, 0 for the neurons that are not in the pattern
+    pattern_terms = np.exp(-1j * read_pattern_phases(pattern_file, number_patterns, number_neurons)[:observed])
+    pattern_terms[np.isnan(pattern_terms)] = 0
+
+    # cumulative number of spikes and sums of exp(i * (2 pi t / T - phi)) for each pattern and T before each edge
+    counts = np.zeros(edges.shape[0])
+    last_times = np.zeros(edges.shape[0])  # time of the last spike before each edge, 0 if there is none
+    sums = np.zeros((observed, periods.shape[0], edges.shape[0]), dtype=np.complex128)
+    n_spikes = 0
+    last_time = -np.inf
+    for chunk in iter_spike_chunks(spike_file, chunksize=chunksize):
+        times = np.asarray(chunk['time'])
+        neurons = np.asarray(chunk['neuron'], dtype=np.int64)
+        # how many spikes of the chunk come before each edge
+        before = np.searchsorted(times, edges, side='left')
+        counts += before
+        last_times[before > 0] = times[before[before > 0] - 1]
+        for mu in range(observed):
+            # only the spikes of the neurons of the pattern add to the sums
+            in_pattern = pattern_terms[mu][neurons] != 0
+            pattern_times = times[in_pattern]
+            terms = pattern_terms[mu][neurons[in_pattern]]
+            pattern_before = np.searchsorted(pattern_times, edges, side='left')
+            for k, period in enumerate(periods):
+                cumulative = np.concatenate([[0], np.cumsum(np.exp(2j * np.pi * pattern_times / period) * terms)])
+                sums[mu, k] += cumulative[pattern_before]
+        n_spikes += times.shape[0]
+        if times.shape[0]:
+            last_time = times[-1]
+
+    n_windows = ends.shape[0]
+    spikes_in_window = counts[n_windows:] - counts[:n_windows]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlaps_by_period = np.abs(sums[:, :, n_windows:] - sums[:, :, :n_windows]) / spikes_in_window
+    # the first T with the largest overlap (the overlaps of a few spikes can be the same for many T, up to rounding)
+    best = np.argmax(overlaps_by_period >= np.max(overlaps_by_period, axis=1, keepdims=True) - 1e-9, axis=1)
+    overlaps = np.take_along_axis(overlaps_by_period, best[:, np.newaxis, :], axis=1)[:, 0, :]
+    windows = periods[best]
+    tmax = np.where(spikes_in_window > 0, last_times[n_windows:], 0)
+    # no spikes means no overlap, as in the q3 files, where the windows shorter than fmin * twin have no overlap either
+    no_overlap = spikes_in_window == 0
+    if not window:
+        no_overlap |= tmax - starts < shortest_fraction * longest_window
+    overlaps[:, no_overlap] = 0
+    windows[(overlaps == 0) | no_overlap[np.newaxis, :]] = 0
+
+    data = np.full((n_windows, 9 + 2 * pout), np.nan)
+    data[:, 0:3] = (sigma, delta, alpha)
+    data[:, 3] = starts
+    data[:, 4] = tmax
+    data[:, 5] = spikes_in_window
+    data[:, 6] = np.argmax(overlaps, axis=0)
+    data[:, 7] = np.max(overlaps, axis=0)
+    # the windows of the simulation that end before time_ini (the q3 files start from step) have overlap 0
+    padding = int(round(time_ini / step)) if not window else 0
+    max_overlaps = np.concatenate([np.zeros(padding), data[:, 7]])
+    data[:, 8] = pd.Series(max_overlaps).rolling(n_fluctuations, min_periods=1).var(ddof=0).to_numpy()[padding:]
+    data[:, 9:9 + 2 * observed:2] = windows.T
+    data[:, 10:10 + 2 * observed:2] = overlaps.T
+
+    # the simulation stopped (maxsp2) or stopped writing spikes (maxsp): after the last spike there is no data
+    if n_spikes >= max_spikes:
+        data[ends > last_time, 3:] = np.nan
+
+    df = pd.DataFrame(data, columns=q3_columns(pout)[:-4])
+    df['P'] = np.int64(number_patterns)
+    df['range'] = float(mixing_range)
+    df['line'] = np.arange(n_windows, 0, -1, dtype=np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        df['rate'] = df['# spike'] / (df['tmax'] - df['tmin'])
+    return df
+
+def compare_with_q3(run: dict, tolerance: float=1e-3, **kwargs) -> dict:
+    """
+    Recalculates a run (a dictionary of find_runs) with the windows of the simulation (window=None, step=flush) and
+    compares it with the q3 file of the run, line by line from the last one. kwargs are passed to rewindow_spike_file.
+    Returns the largest absolute difference of '# spike', 'tmax', 'max overlap', 'fluctuations' and of all the overlaps
+    and windows of the patterns, the fraction of the windows with the same which_max (only where there is an overlap)
+    and 'ok', True if all the differences are below tolerance and which_max is always the same.
+    """
+    parameters = read_run_parameters(run['output_file'])
+    step = float(parameters['flush']) * float(parameters.get('bin', 1))
+    df = rewindow_spike_file(step=step, **run, **kwargs)
+    q3_file = os.path.join(os.path.dirname(run['spike_file']), 'q3-' + os.path.basename(run['spike_file'])[len('spikes3-'):])
+    q3_values = read_dat(q3_file)
+
+    number_rows = min(df.shape[0], q3_values.shape[0])
+    number_columns = min(df.shape[1] - 4, q3_values.shape[1])
+    values = df.iloc[-number_rows:, :number_columns].to_numpy()
+    q3_values = q3_values[-number_rows:, :number_columns]
+    with np.errstate(invalid='ignore'):
+        differences = np.abs(values - q3_values)
+    # the rows after the end of the spikes (maxsp) are NaN in both
+    differences[np.isnan(values) & np.isnan(q3_values)] = 0
+
+    columns = list(df.columns[:number_columns])
+    def largest(names):
+        indices = [columns.index(name) for name in names if name in columns]
+        return float(np.max(differences[:, indices])) if indices and number_rows else 0.0
+    overlap_rows = q3_values[:, 7] > 0
+    result = {
+        'spike_file': run['spike_file'],
+        'windows': number_rows,
+        '# spike': largest(['# spike']),
+        'tmax': largest(['tmax']),
+        'max overlap': largest(['max overlap']),
+        'fluctuations': largest(['fluctuations']),
+        'overlaps': largest([name for name in columns if name.startswith('overlap pattern')]),
+        'windows of the patterns': largest([name for name in columns if name.startswith('window pattern')]),
+        'same which_max': float(np.mean(values[overlap_rows, 6] == q3_values[overlap_rows, 6])) if overlap_rows.any() else 1.0,
+    }
+    result['ok'] = bool(max(result['# spike'], result['max overlap'], result['fluctuations'], result['overlaps']) <= tolerance
+                        and result['same which_max'] == 1)
+    return result
+
+def check_simulation(simulation_dir: str, tolerance: float=1e-3, workers: int=None, **kwargs) -> pd.DataFrame:
+    """
+    Runs compare_with_q3 on all the runs of a simulation (in a pool of 'workers' processes) and prints how many
+    of them reproduce their q3 file within tolerance. Returns a dataframe with one row per run.
+    """
+    runs = find_runs(simulation_dir)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(compare_with_q3, run, tolerance=tolerance, **kwargs) for run in runs]
+        df = pd.DataFrame([future.result() for future in futures])
+    print(f"{int(df['ok'].sum())} of {df.shape[0]} runs reproduce the q3 files within {tolerance}")
+    if not df['ok'].all():
+        print(purple(df[~df['ok']].drop(columns='ok').to_string(index=False)))
+    return df
+
+def find_runs(simulation_dir: str) -> list:
+    """
+    Returns a list of dictionaries with the files (spikes3, PATTERN, output) and P and range of every run of a simulation
+    """
+    catalog = build_catalog(simulation_dir, directories_matching_pattern=directories_matching_pattern)
+    runs = []
+    for run_dir in files_of_kind(catalog, 'dir').itertuples():
+        files = catalog[(catalog['P'] == run_dir.P) & (catalog['range'] == run_dir.range)]
+        pattern_files = files_of_kind(files, 'PATTERN')['path'].tolist()
+        if len(pattern_files) != 1:
+            print(purple(f"dir = {os.path.basename(run_dir.path)}: {len(pattern_files)} PATTERN files, not counted"))
+            continue
+        # only the files with sigma, delta and alpha in the name (not the .spk stores), as in q3merge.merge_time_series
+        for spike_file in files_of_kind(files, 'spikes3').dropna(subset=['sigma'])['path']:
+            filename = os.path.basename(spike_file)
+            output_file = os.path.join(run_dir.path, 'output-' + filename[len('spikes3-'):-len('.dat')] + '.txt')
+            runs.append({
+                'spike_file': spike_file,
+                'pattern_file': pattern_files[0],
+                'output_file': output_file,
+                'number_patterns': run_dir.P,
+                'mixing_range': run_dir.range,
+            })
+    return runs
+
+def rewindow_simulation(
+        simulation_dir: str,
+        simulation_name: str,
+        window: float=None,
+        step: float=10,
+        workers: int=None,
+        save: bool=True,
+        **kwargs
+        ) -> pd.DataFrame:
+    """
+    Recalculates the q3 data of all the runs of a simulation with rewindow_spike_file (kwargs are passed to it),
+    in a pool of 'workers' processes.
+    If save is True the result is saved as "q3-{simulation_name}-window{window}-step{step}.feather" in the simulation
+    directory: pass q3_name="q3-{simulation_name}-window{window}-step{step}" to Simulation to use it instead of the q3 files.
+    """
+    runs = find_runs(simulation_dir)
+    if not runs:
+        raise ValueError(purple(f"No spikes3 file found in {simulation_dir}"))
+    print(f"{len(runs)} spikes3 files, window = {window}, step = {step}")
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(rewindow_spike_file, window=window, step=step, **run, **kwargs) for run in runs]
+        df = pd.concat([future.result() for future in futures], ignore_index=True)
+
+    if save:
+        q3_name = f"q3-{simulation_name}-window{window}-step{step}"
+        df.to_feather(os.path.join(simulation_dir, q3_name + '.feather'))
+        print(f"Saved, use q3_name='{q3_name}' in Simulation")
+    return df
+
+def purple(string: str):
+    return "\033[95m" + string + "\033[0m"
+
+
+if __name__ == "__main__":
+    rewindow_simulation(simulation_dir=r'./example_simulation', simulation_name='example_simulation', window=50, step=10)
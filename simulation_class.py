@@ -1,19 +1,30 @@
-import os, re
+import os, re, sys
+import subprocess
+import time
+import hashlib
+import io
+import glob
+import threading
 import itertools
+import functools
+from concurrent.futures import ProcessPoolExecutor
 from typing import Tuple, List, Callable
 
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib
-import seaborn as sns
 
-import ipywidgets as widgets
-from ipywidgets import Output
-from IPython.display import display, Image
+# pyarrow.dataset (only for the parquet datasets), matplotlib, seaborn, ipywidgets and IPython are imported by the
+# methods that use them, so the class can be imported quickly on machines (or jobs) that only read the data.
+# import_time measures how long the import takes, tests/test_import_time.py checks it (python -m pytest tests).
+
+from catalog import build_catalog, files_of_kind, find_connessioni_files
+from dat_reader import read_run_parameters
 
 
 class Simulation:
+    # columns of q3_merged_df_light
+    light_columns = ['sigma','delta','alpha','tmin','tmax','# spike','which_max','max overlap','fluctuations','window pattern 0','overlap pattern 0','P','range','line','rate']
+
     def __init__(
             self, 
             files_dir: str, #? example: /home/ilenia/OutputFiles
@@ -22,7 +33,15 @@ class Simulation:
             numbers_of_patterns: List[str]=[], 
             mixing_ranges: List[str]=[], 
             max_lines: int=1,
-            directories_matching_pattern: str = r'P-([\d\.]+)--range-([\d\.]+)' #! should contain P and range
+            directories_matching_pattern: str = r'P-([\d\.]+)--range-([\d\.]+)', #! should contain P and range
+            pivot_cache_size: int=256,  # how many pivots (and slices) of the q3 data are kept in memory
+            frame_cache_size: int=64,  # how many images of slider_image are kept in memory
+            frame_disk_cache: bool=False,  # also save the images of slider_image in the folder "frames"
+            frame_style: str='seaborn',  # images of slider_image: 'seaborn' (as plot_heatmap_overlap_fluctuations_whichmax_3) or 'fast', see set_frame_cache
+            q3_name: str=None,  # name of the merged q3 file without extension, default is "q3-{simulation_name}"
+            q3_columns: List[str]=None,  # columns of the merged q3 file to load besides light_columns, None means all of them
+            follow: bool=False,  # read the q3 files of a simulation that is still running instead of the merged file, see refresh
+            refresh_catalog: bool=False  # list all the files again instead of using the catalog saved by q3merge.py (see catalog.py)
             ):
         
         self.files_dir = files_dir
@@ -31,38 +50,50 @@ class Simulation:
         self.mixing_ranges = mixing_ranges
         self.max_lines = max_lines
         self.directories_matching_pattern = directories_matching_pattern
+        self.q3_name = q3_name if q3_name else 'q3-' + simulation_name
 
         # Calculate the real simulation directory
         dir = os.path.join(files_dir, simulation_name)
         self.dir = dir.replace("/", os.sep).replace("\\", os.sep)
 
+        # all the files of the runs, listed once (see catalog.py), it is not saved so the directory can be read only
+        self.catalog = build_catalog(self.dir, directories_matching_pattern=directories_matching_pattern, refresh=refresh_catalog)
+
         # Look for feather file of all q3 files merged
-        q3_merged_path = os.path.join(self.dir, 'q3-' + self.simulation_name + '.feather')
+        q3_merged_path = os.path.join(self.dir, self.q3_name + '.feather')
         #? example of how the file is formatted, in the case of 20 patterns: 
         #? sigma,delta,alpha,tmin,tmax,# spike,which_max,max overlap,fluctuations,window pattern 0,overlap pattern 0,...,window pattern 19,overlap pattern 19,P,range,line,rate
 
-        if os.path.isfile(q3_merged_path):
-            self.q3_merged_df = pd.read_feather(q3_merged_path)
+        # Or for the dataset partitioned by P and range (q3merge.py with out_format='.parquet')
+        q3_dataset_path = os.path.join(self.dir, self.q3_name + '.parquet')
+        self.q3_dataset = None
 
-            # create a lighter version, may be useful later
-            columns = ['sigma','delta','alpha','tmin','tmax','# spike','which_max','max overlap','fluctuations','window pattern 0','overlap pattern 0','P','range','line','rate']
-            self.q3_merged_df_light = self.q3_merged_df[columns]
+        self.q3_merged_path = q3_merged_path
 
-            # calculate numbers of patterns, mixing ranges, sigmas, deltas, alphas from the file
-            self.int_n_patterns = sorted(self.q3_merged_df['P'].unique().tolist())
-            self.float_mixing_ranges = sorted(self.q3_merged_df['range'].unique().tolist())
+        # views (like slider_image) updated by refresh
+        self.follower = None
+        self._refresh_views = []
 
-            self.sigmas = sorted(self.q3_merged_df['sigma'].unique().tolist())
-            self.deltas = sorted(self.q3_merged_df['delta'].unique().tolist())
-            self.alphas = sorted(self.q3_merged_df['alpha'].unique().tolist())
+        if follow:
+            # the q3 files are read in memory and then only the lines added to them are read (see follow.py)
+            from follow import Follower
+            self.follower = Follower(self.dir, directories_matching_pattern=directories_matching_pattern)
+            self.follower.poll()
+            if self.follower.q3_df is None:
+                raise ValueError(Simulation.purple(f"No q3 lines written yet in {self.dir}"))
+            self.set_q3_data(self.follower.q3_df, light=False)
 
-            # Sometimes fluctuations can be negative (numerical error)
-            self.min_fluctuations = self.q3_merged_df['fluctuations'][self.q3_merged_df['fluctuations'] > 0].min()
-            self.max_fluctuations = self.q3_merged_df['fluctuations'].max()
+            self.q3merged = True
 
-            self.max_lines = self.q3_merged_df['line'].max()
+        elif os.path.isfile(q3_merged_path):
+            columns = None if q3_columns is None else list(dict.fromkeys(Simulation.light_columns + list(q3_columns)))
+            self.set_q3_data(read_feather_columns(q3_merged_path, columns=columns))
 
-            self.max_rate = self.q3_merged_df['rate'].max()
+            self.q3merged = True
+
+        elif os.path.isdir(q3_dataset_path):
+            print(f"Simulation class: feather file not found, opening the dataset '{q3_dataset_path}' lazily.")
+            self.open_q3_dataset(q3_dataset_path)
 
             self.q3merged = True
 
@@ -92,7 +123,125 @@ class Simulation:
         self.df_paths_connessioni = self.extract_connessioni_file()
 
         self.threshold = 0.9
+
+        # LRU caches used by pivot_df
+        self.set_pivot_cache_size(pivot_cache_size)
+
+        # LRU cache of the images of slider_image (see get_frame) and the thread that makes the next ones in advance
+        self._frame_lock = threading.Lock()
+        self._prefetch_condition = threading.Condition()
+        self._prefetch_keys = []
+        self._prefetch_thread = None
+        self._last_frame_request = 0
+        self.set_frame_cache(frame_cache_size, disk_cache=frame_disk_cache, frame_style=frame_style)
+
+        # merged medie3, temp3 and rate3 data, read the first time they are used (see read_time_series)
+        self._time_series = {}
+        # tables of spike_stats.py, see read_spike_stats
+        self._spike_stats = {}
+
+        # dense arrays of the heatmaps of the whole sweep, see build_tensors and load_tensors
+        self.tensors = {}
+        self.tensors_dir = os.path.join(self.dir, 'q3-' + self.simulation_name + '-tensors')
     
+    def set_q3_data(self, df: pd.DataFrame, light: bool=True):
+        """
+        Uses df as q3_merged_df and calculates from it the positions of the slices, numbers of patterns, mixing ranges and global values.
+        With light=False q3_merged_df_light is q3_merged_df itself: the follow mode changes it in place, and a view
+        with only some columns would make pandas copy the columns at every change.
+        """
+        self.q3_merged_df = df
+
+        # create a lighter version, may be useful later. It is made from the columns of q3_merged_df with copy=False
+        # so that it shares their memory (df[columns] would copy them with pandas < 3)
+        self.q3_merged_df_light = pd.DataFrame({column: df[column] for column in Simulation.light_columns}, copy=False) if light else df
+        print(f"Simulation class: q3 data loaded, {self.memory_usage():.1f} MB")
+
+        # positions of the rows of each (P, range, line), so pivot_df does not need to scan the whole dataframe
+        # (observed=True: only the couples that are in the data, also when P and range are categorical)
+        self.q3_slices = self.q3_merged_df_light.groupby(['P', 'range', 'line'], observed=True).indices
+
+        # calculate numbers of patterns, mixing ranges, sigmas, deltas, alphas from the file
+        self.int_n_patterns = sorted(self.q3_merged_df['P'].unique().tolist())
+        self.float_mixing_ranges = sorted(self.q3_merged_df['range'].unique().tolist())
+        self.calculate_global_values(self.q3_merged_df)
+
+    def refresh(self) -> dict:
+        """
+        Only with follow=True: reads the lines added to the q3 files since the last refresh (see follow.Follower.poll,
+        whose result is returned) and updates the q3 data, the global values, the caches and the open slider_image.
+        Without new q3 files only the new rows are used, so the cost depends on how much was added.
+        """
+        if self.follower is None:
+            raise ValueError(Simulation.purple("refresh: the simulation was not made with follow=True"))
+        changes = self.follower.poll()
+        if not changes['new q3 rows']:
+            return changes
+
+        if changes['new q3 files']:
+            self.set_q3_data(self.follower.q3_df, light=False)
+        else:
+            self.update_global_values(self.follower.q3_df.iloc[changes['rows']])
+
+        # the pivots and frames of the changed lines are not valid anymore
+        # (frames saved on disk are kept, their name has the hash of their data)
+        self.set_pivot_cache_size(self.pivot_cache_size)
+        self.set_frame_cache(self.frame_cache_size, disk_cache=self.frame_disk_cache is not None, frame_dpi=self.frame_dpi,
+                             frame_style=self.frame_style)
+        for update_view in self._refresh_views:
+            update_view()
+        return changes
+
+    def update_global_values(self, rows: pd.DataFrame):
+        """
+        Updates the global minimum and maximum of fluctuations and rate with some new rows of the q3 data
+        (sigmas, deltas, alphas and lines do not change while the files of a simulation are being written)
+        """
+        # np.fmin and np.fmax ignore NaN (rows not written yet)
+        fluctuations = rows['fluctuations']
+        self.min_fluctuations = float(np.fmin(self.min_fluctuations, fluctuations[fluctuations > 0].min()))
+        self.max_fluctuations = float(np.fmax(self.max_fluctuations, fluctuations.max()))
+        self.max_rate = float(np.fmax(self.max_rate, rows['rate'].max()))
+
+    def calculate_global_values(self, df):
+        """
+        Calculates sigmas, deltas, alphas and the global minimum and maximum of fluctuations, line and rate from a q3 merged dataframe
+        """
+        self.sigmas = sorted(df['sigma'].unique().tolist())
+        self.deltas = sorted(df['delta'].unique().tolist())
+        self.alphas = sorted(df['alpha'].unique().tolist())
+
+        # Sometimes fluctuations can be negative (numerical error)
+        # (python numbers, the columns may be float32 or int16, see q3merge.compact_dtypes)
+        self.min_fluctuations = float(df['fluctuations'][df['fluctuations'] > 0].min())
+        self.max_fluctuations = float(df['fluctuations'].max())
+
+        self.max_lines = int(df['line'].max())
+
+        self.max_rate = float(df['rate'].max())
+
+    def open_q3_dataset(self, q3_dataset_path):
+        """
+        Opens the dataset partitioned by P and range written by q3merge.py without loading it in memory.
+        Only the few columns needed for the global values are read now, pivot_df then reads only the partition it needs.
+        q3_merged_df and q3_merged_df_light are None in this case.
+        """
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+        partitioning = ds.partitioning(pa.schema([('P', pa.int64()), ('range', pa.float64())]), flavor='hive')
+        self.q3_dataset = ds.dataset(q3_dataset_path, format='parquet', partitioning=partitioning)
+        self.q3_merged_df = None
+        self.q3_merged_df_light = None
+        self.q3_slices = None
+
+        # numbers of patterns and mixing ranges are in the names of the partitions
+        partition_keys = [ds.get_partition_keys(fragment.partition_expression) for fragment in self.q3_dataset.get_fragments()]
+        self.int_n_patterns = sorted({keys['P'] for keys in partition_keys})
+        self.float_mixing_ranges = sorted({keys['range'] for keys in partition_keys})
+
+        columns = ['sigma', 'delta', 'alpha', 'fluctuations', 'line', 'rate']
+        self.calculate_global_values(self.q3_dataset.to_table(columns=columns).to_pandas())
+
     def print_values(self):
         # todo - make this function print more useful info
         print(f'self.files_dir = {self.files_dir}')
@@ -127,41 +276,186 @@ class Simulation:
         """
         Finds and returns in a dataframe all the directories of the files CONNESSIONI
         """
-        # Create empty  dataframe
-        df_connessioni = pd.DataFrame(columns=['P', 'range', 'connessioni_file'])
-
-        # Create a regular expression pattern for files starting with 'CONNESSIONI'
-        pattern = r'^CONNESSIONI.*'
-
-        for entry in os.listdir(self.dir):
-            full_path = os.path.join(self.dir, entry)
-            
-            if os.path.isdir(full_path):
-                # Extract P and range:
-                try:
-                    number_patterns, mixing_range = self.extract_numbers(entry)
-                    files = os.listdir(full_path)
-                    # Filter the files based on the pattern using re.match
-                    matching_files = [f for f in files if re.match(pattern, f)]
-                    # Get the full paths of the matching files
-                    matching_file_paths = [os.path.join(full_path, f) for f in matching_files]
-
-                    # Check if exactly one file matches the pattern
-                    if len(matching_file_paths) == 1:
-                        # Add the found file path to the dataframe
-                        new_row = {'P': number_patterns, 'range': mixing_range, 'connessioni_file':matching_file_paths[0]}
-                        df_connessioni.loc[len(df_connessioni)] = new_row
-                        #* print(f'dir = {entry}: P={number_patterns}, range={mixing_range}, single file CONNESSIONI found')
-                    else:
-                        if len(matching_file_paths) == 0:
-                            print(Simulation.purple("No file starting with 'CONNESSIONI' was found."))
-                        else:
-                            print(Simulation.purple("Multiple files starting with 'CONNESSIONI' were found."))
-
-                except ValueError:
-                    print(f'dir = {entry}: not counted')
-        # Return the dataframe
-        return df_connessioni
+        return find_connessioni_files(self.catalog)
+
+    def connessioni_path(self, n_patterns: int, mixing_range: float) -> str:
+        """
+        Returns the path of the file CONNESSIONI of the simulation with the selected number of patterns and range
+        """
+        df = self.df_paths_connessioni
+        paths = df['connessioni_file'][(df['P'] == n_patterns) & (df['range'] == mixing_range)]
+        if paths.empty:
+            raise ValueError(Simulation.purple(f"No file CONNESSIONI for P={n_patterns}, range={mixing_range}"))
+        return paths.iloc[0]
+
+    def load_connessioni(self, n_patterns: int, mixing_range: float, sparse_threshold: float=None):
+        """
+        Returns the connectivity matrix (N x N) of the simulation with the selected number of patterns and range.
+        The first time the text file is converted to a float32 .npy file next to it ("binary-CONNESSIONI...npy"), then it is just memory mapped.
+        If sparse_threshold is passed returns a scipy CSR matrix with only the connections with |J| > sparse_threshold,
+        also saved next to the text file (.npz) the first time. This needs scipy.
+        The binary files are made again if the text file is newer.
+        """
+        path = self.connessioni_path(n_patterns, mixing_range)
+        matrix = load_connessioni_matrix(path)
+
+        if sparse_threshold is None:
+            return matrix
+
+        import scipy.sparse  # only needed for the sparse version
+        sparse_path = connessioni_cache_path(path, f'-csr-{sparse_threshold}.npz')
+        if not Simulation.is_newer(sparse_path, path):
+            rows, cols = np.nonzero(np.abs(matrix) > sparse_threshold)
+            sparse_matrix = scipy.sparse.csr_matrix((matrix[rows, cols], (rows, cols)), shape=matrix.shape, dtype=np.float32)
+            scipy.sparse.save_npz(sparse_path, sparse_matrix)
+            return sparse_matrix
+        return scipy.sparse.load_npz(sparse_path)
+
+    def read_q3_columns(self, columns: List[str]) -> pd.DataFrame:
+        """
+        Returns the selected columns of all the q3 data (from the dataset only these columns are read)
+        """
+        if self.q3_dataset is not None:
+            return self.q3_dataset.to_table(columns=columns).to_pandas()
+        if not set(columns).issubset(self.q3_merged_df.columns):
+            # not loaded (see q3_columns), read them from the file
+            return read_feather_columns(self.q3_merged_path, columns=columns)
+        return self.q3_merged_df[columns]
+
+    def memory_usage(self) -> float:
+        """
+        Memory in MB of the q3 data in memory (q3_merged_df_light shares the columns of q3_merged_df, so it is not counted)
+        """
+        if self.q3_merged_df is None:
+            return 0.0
+        return self.q3_merged_df.memory_usage(deep=True).sum() / 1e6
+
+    def read_time_series(self, kind: str, columns: List[str]=None) -> pd.DataFrame:
+        """
+        Returns the merged medie3, temp3 or rate3 data of all the runs (made by q3merge.merge_time_series),
+        with P and range (and sigma, delta, alpha) as columns, so a query on many runs is a single read.
+        With columns only those columns are read, otherwise the whole dataframe is read the first time and then kept
+        (it is also available as medie3_df, temp3_df and rate3_df).
+        """
+        if columns is None and kind in self._time_series:
+            return self._time_series[kind]
+
+        merged_path = os.path.join(self.dir, f'{kind}-{self.simulation_name}')
+        if os.path.isfile(merged_path + '.feather'):
+            df = pd.read_feather(merged_path + '.feather', columns=columns)
+        elif os.path.isdir(merged_path + '.parquet'):
+            import pyarrow as pa
+            import pyarrow.dataset as ds
+            partitioning = ds.partitioning(pa.schema([('P', pa.int64()), ('range', pa.float64())]), flavor='hive')
+            df = ds.dataset(merged_path + '.parquet', format='parquet', partitioning=partitioning).to_table(columns=columns).to_pandas()
+        else:
+            raise FileNotFoundError(Simulation.purple(f"'{merged_path}.feather' not found, use q3merge.merge_time_series to make it"))
+
+        if columns is None:
+            self._time_series[kind] = df
+        return df
+
+    @property
+    def medie3_df(self) -> pd.DataFrame:
+        return self.read_time_series('medie3')
+
+    @property
+    def temp3_df(self) -> pd.DataFrame:
+        return self.read_time_series('temp3')
+
+    @property
+    def rate3_df(self) -> pd.DataFrame:
+        return self.read_time_series('rate3')
+
+    def read_spike_stats(self, table: str='runs') -> pd.DataFrame:
+        """
+        Returns a table ('runs', 'modules', 'neurons' or 'isi') of the spike statistics made by spike_stats.spike_stats_simulation,
+        read the first time and then kept.
+        """
+        if table not in self._spike_stats:
+            path = os.path.join(self.dir, f'spike-stats-{table}-{self.simulation_name}.feather')
+            if not os.path.isfile(path):
+                raise FileNotFoundError(Simulation.purple(f"'{path}' not found, use spike_stats.spike_stats_simulation to make it"))
+            self._spike_stats[table] = pd.read_feather(path)
+        return self._spike_stats[table]
+
+    def join_spike_stats(self, df: pd.DataFrame=None, columns: List[str]=None) -> pd.DataFrame:
+        """
+        Adds to the rows of df (q3_merged_df_light if None) the spike statistics of their run (table 'runs' of read_spike_stats,
+        only 'columns' if not None), matching P, range, sigma, delta and alpha. The statistics have the same name with
+        "spikes " in front, like 'spikes synchrony'.
+        """
+        df = self.q3_merged_df_light if df is None else df
+        keys = ['P', 'range', 'sigma', 'delta', 'alpha']
+        stats = self.read_spike_stats('runs')
+        stats = stats[keys + [column for column in stats.columns if column not in keys and (columns is None or column in columns)]]
+        # same dtypes as the q3 data (P and range may be categorical, see q3merge.compact_dtypes)
+        stats = stats.astype({key: df[key].dtype for key in keys}).rename(columns=lambda column: column if column in keys else 'spikes ' + column)
+        return df.merge(stats, on=keys, how='left')
+
+    def analysis_path(self, name: str) -> str:
+        """
+        Path of the feather file where the result of an analysis called 'name' is saved
+        """
+        return os.path.join(self.dir, f'{name}-{self.simulation_name}.feather')
+
+    def calculate_capacity(self,
+        what: str='overlap pattern 0',
+        line: int=1,
+        by: List[str]=['range', 'sigma', 'delta'],
+        aggregate: str='mean',
+        save: bool=True
+        ) -> pd.DataFrame:
+        """
+        Storage capacity: for each group of the columns in 'by', the largest number of patterns P such that
+        'what' at the selected line is >= self.threshold for that P and for all the smaller ones (0 if there is none).
+        Over the parameters that are not in 'by' (for example sigma and delta if by=['range']) 'what' is reduced with 'aggregate'.
+        Everything is done with groupby reductions on the whole q3 data.
+        Returns a tidy dataframe with the columns in 'by' and 'capacity', saved with analysis_path if save is True.
+        """
+        df = self.read_q3_columns(list(dict.fromkeys(by + ['P', 'line', what])))
+        df = df[df['line'] == line]
+
+        # P and range may be categorical (q3merge.compact_dtypes): observed=True, otherwise the combinations that are
+        # not in the data would be NaN rows, counted as not recalled
+        recall = df.groupby(by + ['P'], observed=True)[what].agg(aggregate).reset_index().sort_values(by + ['P'])
+        recall['P'] = recall['P'].astype(np.int64)
+        # NaN (missing simulations) count as not recalled
+        recall['recalled'] = recall[what] >= self.threshold
+        # recalled for this P and all the smaller ones
+        recall['recalled'] = recall.groupby(by, observed=True)['recalled'].cummin()
+        recall['capacity'] = recall['P'].where(recall['recalled'], 0)
+        capacity = recall.groupby(by, observed=True)['capacity'].max().reset_index()
+
+        if save:
+            capacity.to_feather(self.analysis_path(f'capacity-{what}-line{line}'))
+        return capacity
+
+    def calculate_modularity(self, workers: int=None, save: bool=True) -> pd.DataFrame:
+        """
+        Modularity (see connessioni_modularity) of the connectivity matrix of every (P, range), in a pool of 'workers' processes.
+        The modules are the sites of Z neurons, with Z read from output-connessioni.txt of each run.
+        Returns a tidy dataframe with P, range and modularity, saved with analysis_path if save is True.
+        """
+        paths = self.df_paths_connessioni
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            modularity = list(executor.map(connessioni_modularity, paths['connessioni_file']))
+
+        df = pd.DataFrame({'P': paths['P'].astype(np.int64), 'range': paths['range'].astype(np.float64), 'modularity': modularity})
+        df = df.sort_values(['P', 'range'], ignore_index=True)
+
+        if save:
+            df.to_feather(self.analysis_path('modularity'))
+        return df
+
+    @staticmethod
+    def purple(string: str):
+        return "\033[95m" + string + "\033[0m"
+
+    @staticmethod
+    def is_newer(path: str, reference_path: str) -> bool:
+        """True if path exists and was modified after reference_path"""
+        return os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(reference_path)
 
     def set_min_fluctuations(self, v_min):
         """Manually set the minimum of the fluctuations"""
@@ -175,44 +469,154 @@ class Simulation:
         """
         Find the values of sigmas and deltas when not merging the q3 files
         """
-        # Get one of the directories of the simulations
-        pattern = self.numbers_of_patterns[0]
-        mixing_range = self.mixing_ranges[0]
-        first_folder = f'P-{pattern}--range-{mixing_range}'
-        directory = os.path.join(self.dir, first_folder)
-        
-        # Lists to store unique values
-        sigmas = set()
-        deltas = set()
-
-        # Go over all the files q3 in that dorectory to retrieve the values of sigmas and deltas
-        for filename in os.listdir(directory):
-            if filename[:2] == 'q3':    
-                filepath = os.path.join(directory, filename)
-                if os.path.isfile(filepath):
-                    with open(filepath) as file:
-                        df = pd.read_csv(file, sep='\s+').to_numpy()
-                        sigmas.add(df[0][0])
-                        deltas.add(df[0][1])
+        # Get the q3 files of one of the directories of the simulations
+        q3_files = files_of_kind(self.catalog, 'q3')
+        q3_files = q3_files[(q3_files['P'] == int(self.numbers_of_patterns[0])) & (q3_files['range'] == float(self.mixing_ranges[0]))]
+
+        # sigma and delta are in the names of the files, like "q3-5.5-0-0.5.dat"
+        sigmas = set(q3_files['sigma'].dropna())
+        deltas = set(q3_files['delta'].dropna())
 
         # Set the values of sigmas and deltas of the simulation object as ordered lists
         self.sigmas = sorted(sigmas, key=float)
         self.deltas = sorted(deltas, key=float)
         
+    def set_pivot_cache_size(self, pivot_cache_size: int):
+        """
+        Sets how many pivots (and slices) are kept in memory by pivot_df, this also empties the caches
+        """
+        self.pivot_cache_size = pivot_cache_size
+        # the methods are looked up at every miss, not bound here, so that instrumentation.enable also records the
+        # objects made before it
+        self._slice_cache = functools.lru_cache(maxsize=pivot_cache_size)(lambda *key: self._read_slice(*key))
+        self._pivot_cache = functools.lru_cache(maxsize=pivot_cache_size)(lambda *key: self._make_pivot(*key))
+
+    def get_slice(self, n_patterns: int, mixing_range: float, line: int) -> pd.DataFrame:
+        """
+        Returns the rows of q3_merged_df_light with the selected number of patterns, range and line.
+        Results are kept in a LRU cache, so do not modify them.
+        """
+        return self._slice_cache(n_patterns, mixing_range, line)
+
+    def _read_slice(self, n_patterns: int, mixing_range: float, line: int) -> pd.DataFrame:
+        if self.q3_dataset is not None:
+            import pyarrow.dataset as ds
+            # read only the partition of (P, range) and the columns of the light version
+            return self.q3_dataset.to_table(
+                columns=Simulation.light_columns,
+                filter=(ds.field('P') == n_patterns) & (ds.field('range') == mixing_range) & (ds.field('line') == line)
+            ).to_pandas()
+
+        # use the positions calculated in __init__ instead of filtering the whole dataframe
+        positions = self.q3_slices.get((n_patterns, mixing_range, line), [])
+        return self.q3_merged_df_light.iloc[positions]
+
     def pivot_df(self, what: str, n_patterns: int, mixing_range: float, line: int):
         """
         Returns a pivot dataframe, useful for plotting heatmaps, of 'what' as a function of sigma and delta
         'what' can be, for example 'overlap', 'max_overlap', 'overlap pattern 0', 'fluctuations'
+        Pivots are kept in a LRU cache of size pivot_cache_size (see set_pivot_cache_size), so do not modify them.
         """
-        df = self.q3_merged_df_light
-        # df = self.q3_merged_df
-        filtered_df = df[
-            (df['P'] == n_patterns) &
-            (df['range'] == mixing_range) &
-            (df['line'] == line)
-        ]
+        return self._pivot_cache(what, n_patterns, mixing_range, line)
+
+    def _make_pivot(self, what: str, n_patterns: int, mixing_range: float, line: int):
+        if what in self.tensors:
+            return self.tensor_pivot(what, n_patterns=n_patterns, mixing_range=mixing_range, line=line)
+        filtered_df = self.get_slice(n_patterns, mixing_range, line)
         return filtered_df.pivot(index='delta', columns='sigma', values=what)
 
+    def tensor_axes(self) -> dict:
+        """
+        Returns the axes of the tensors: numbers of patterns, mixing ranges, lines, deltas and sigmas
+        """
+        return {
+            'P': np.array(self.int_n_patterns, dtype=np.int64),
+            'range': np.array(self.float_mixing_ranges, dtype=np.float64),
+            'line': np.arange(1, self.max_lines + 1, dtype=np.int64),
+            'delta': np.array(self.deltas, dtype=np.float64),
+            'sigma': np.array(self.sigmas, dtype=np.float64),
+        }
+
+    def build_tensors(self, whats: List[str]=['max overlap', 'fluctuations', 'rate', 'which_max'], save: bool=True):
+        """
+        Builds, for each column in 'whats', a dense array with axes (P, range, line, delta, sigma) of the whole sweep,
+        NaN where a simulation is missing.
+        If save is True the arrays are saved as .npy files in tensors_dir and memory mapped, so that
+        load_tensors can use them again without the q3 data.
+        After this pivot_df (so all the heatmaps) and tensor_min_max just index these arrays.
+        """
+        axes = self.tensor_axes()
+        df = self.read_q3_columns(['P', 'range', 'line', 'delta', 'sigma'] + list(whats))
+
+        # position of each row in the tensors (the axes are sorted)
+        positions = tuple(
+            np.searchsorted(axes[axis], df[axis].to_numpy()) for axis in ['P', 'range', 'line', 'delta', 'sigma']
+        )
+        shape = tuple(len(axis) for axis in axes.values())
+
+        if save:
+            os.makedirs(self.tensors_dir, exist_ok=True)
+            np.savez(os.path.join(self.tensors_dir, 'axes.npz'), **axes)
+
+        for what in whats:
+            tensor = np.full(shape, np.nan)
+            tensor[positions] = df[what].to_numpy(dtype=np.float64)
+            if save:
+                tensor_path = os.path.join(self.tensors_dir, what + '.npy')
+                np.save(tensor_path, tensor)
+                tensor = np.load(tensor_path, mmap_mode='r')
+            self.tensors[what] = tensor
+
+        # the cached pivots may come from the dataframe
+        self.set_pivot_cache_size(self.pivot_cache_size)
+
+    def load_tensors(self) -> bool:
+        """
+        Memory maps the tensors saved by build_tensors.
+        Returns False (and loads nothing) if they are not there or if they were built with different axes.
+        """
+        axes_path = os.path.join(self.tensors_dir, 'axes.npz')
+        if not os.path.isfile(axes_path):
+            return False
+        with np.load(axes_path) as saved_axes:
+            axes = self.tensor_axes()
+            if any(not np.array_equal(saved_axes[axis], values) for axis, values in axes.items()):
+                print(Simulation.purple(f"The tensors in {self.tensors_dir} have different axes from the q3 data, call build_tensors again"))
+                return False
+
+        for filename in os.listdir(self.tensors_dir):
+            if filename.endswith('.npy'):
+                what = filename[:-len('.npy')]
+                self.tensors[what] = np.load(os.path.join(self.tensors_dir, filename), mmap_mode='r')
+        self.set_pivot_cache_size(self.pivot_cache_size)
+        return True
+
+    def tensor_pivot(self, what: str, n_patterns: int, mixing_range: float, line: int) -> pd.DataFrame:
+        """
+        Same as pivot_df but taken from the tensors (all deltas and sigmas of the sweep are in the index and columns)
+        """
+        axes = self.tensor_axes()
+        i_patterns = self.int_n_patterns.index(n_patterns)
+        i_range = self.float_mixing_ranges.index(mixing_range)
+        pivot = pd.DataFrame(
+            self.tensors[what][i_patterns, i_range, line - 1],
+            index=pd.Index(axes['delta'], name='delta'),
+            columns=pd.Index(axes['sigma'], name='sigma'),
+        )
+        return pivot
+
+    def tensor_min_max(self, what: str, positive: bool=False) -> Tuple[float, float]:
+        """
+        Minimum and maximum of 'what' in the whole sweep, from the tensors.
+        With positive=True only values > 0 are used for the minimum (like min_fluctuations).
+        """
+        tensor = np.asarray(self.tensors[what])
+        if positive:
+            minimum = np.nanmin(np.where(tensor > 0, tensor, np.nan))
+        else:
+            minimum = np.nanmin(tensor)
+        return minimum, np.nanmax(tensor)
+
     def plot_overlap(self,
         n_patterns: int,
         mixing_range: float,
@@ -227,6 +631,8 @@ class Simulation:
         Heatmap of the overlap for selected line of the q3 files, range and number of patterns.
         Can save the plot as a file.
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
         # set the data to plot
         pivot = self.pivot_df('max overlap', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
         min_heatmap_overlap, max_heatmap_overlap = 0,  1
@@ -269,6 +675,8 @@ class Simulation:
         Heatmap of the overlap with pattern 0 for selected line of the q3 files, range and number of patterns.
         Can save the plot as a file.
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
         # set the data to plot
         pivot = self.pivot_df('overlap pattern 0', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
         min_heatmap_overlap, max_heatmap_overlap = 0,  1
@@ -318,6 +726,8 @@ class Simulation:
         Heatmap of the rate for selected line of the q3 files, range and number of patterns.
         Can save the plot as a file.
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
         # set the data to plot
         pivot = self.pivot_df('rate', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
         min_rate, max_rate = 0,  self.calculate_max_rate(n_patterns=n_patterns, mixing_range=mixing_range, line=line)
@@ -361,6 +771,9 @@ class Simulation:
         Can save the plot as a file.
         Scale is logarithmic.
         """
+        import matplotlib
+        import matplotlib.pyplot as plt
+        import seaborn as sns
 
         # set the data to plot
         pivot = self.pivot_df('fluctuations', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
@@ -406,6 +819,8 @@ class Simulation:
         Heatmap of the pattern that maximizes the overlap for selected line of the q3 files, range and number of patterns.
         Can save the plot as a file.
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
 
         # set the data to plot
         pivot = self.pivot_df('which_max', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
@@ -451,13 +866,9 @@ class Simulation:
             24_11_19 - uses the single plot functions for the different things
             Can be used to save to file.
             """
+            import matplotlib.pyplot as plt
             fig, ax = plt.subplots(2, 3, sharex=True, sharey=True, figsize=(15,9))
-            self.plot_overlap(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[0,0])
-            self.plot_fluctuations(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[0,1])
-            self.plot_rate(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[0,2])
-            self.plot_overlap_pattern_0(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[1,0])
-            self.plot_which_max(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[1,1])
-            ax[1,2].axis('off')
+            self.draw_heatmap_panels(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax)
 
             # Save the figure if a format is specified in "save_as" into "savedir"
             if save_as:
@@ -480,6 +891,17 @@ class Simulation:
 
 
 
+    def draw_heatmap_panels(self, n_patterns: int, mixing_range: float, line: int, ax):
+        """
+        Draws the panels of plot_heatmap_overlap_fluctuations_whichmax_3 in ax (2 x 3 axes)
+        """
+        self.plot_overlap(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[0,0])
+        self.plot_fluctuations(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[0,1])
+        self.plot_rate(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[0,2])
+        self.plot_overlap_pattern_0(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[1,0])
+        self.plot_which_max(n_patterns=n_patterns, mixing_range=mixing_range, line=line, ax=ax[1,1])
+        ax[1,2].axis('off')
+
     def plot_heatmap_overlap_fluctuations_whichmax_2(
         self,
         n_patterns: int,
@@ -494,6 +916,9 @@ class Simulation:
         Creates plot from the output of q3merge.py (feather file for now)
         It requires for the directory to contain only a file that starts with "q3" and ends woth ".feather"
         """
+        import matplotlib
+        import matplotlib.pyplot as plt
+        import seaborn as sns
         pivot_overlap = self.pivot_df('max overlap', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
         pivot_fluctuations = self.pivot_df('fluctuations', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
         pivot_overlap_pattern_0 = self.pivot_df('overlap pattern 0', n_patterns=n_patterns, mixing_range=mixing_range, line=line)
@@ -551,15 +976,204 @@ class Simulation:
             plt.tight_layout()
         plt.show()
 
+    def heatmap_data(self, n_patterns: int, mixing_range: float, line: int) -> Tuple[dict, dict, str]:
+        """
+        Data of the figure of plot_heatmap_overlap_fluctuations_whichmax_3 as used by export_heatmaps and slider_image:
+        the arrays (delta x sigma, on the sigmas and deltas of the whole simulation) and the color limits of each
+        quantity of heatmap_panels, and the title.
+        """
+        data = {
+            what: self.pivot_df(what, n_patterns=n_patterns, mixing_range=mixing_range, line=line)
+                      .reindex(index=self.deltas, columns=self.sigmas).to_numpy(dtype=np.float64)
+            for what in heatmap_panels
+        }
+        limits = {
+            'max overlap': (0, 1),
+            'fluctuations': (self.min_fluctuations, self.max_fluctuations),
+            'rate': (0, self.calculate_max_rate(n_patterns=n_patterns, mixing_range=mixing_range, line=line)),
+            'overlap pattern 0': (0, 1),
+            'which_max': (0, n_patterns),
+        }
+        title = self.simulation_name + '\n' + f'P-{n_patterns}_range-{mixing_range}_line-{line}'
+        return data, limits, title
+
+    def export_heatmaps(
+            self,
+            savedir: str=None,
+            save_as: str='png',
+            lines: List[int]=None,
+            workers: int=None,
+            force: bool=False,
+            dpi: int=100
+            ) -> pd.DataFrame:
+        """
+        Saves the figure of plot_heatmap_overlap_fluctuations_whichmax_3 for every P, range and line (default: all the lines)
+        in a pool of 'workers' processes with a non-interactive backend, without showing them.
+        Each process draws its figure once and then only changes the data of the images (which max has no annotations).
+        The figures are saved in savedir (default: a "heatmaps" folder in the simulation directory) together with an index
+        "heatmaps-index.csv" with a hash of the data of each figure: figures whose data did not change since the last
+        export are not made again, unless force is True.
+        Returns the index.
+        """
+        if savedir is None:
+            savedir = os.path.join(self.dir, 'heatmaps')
+        os.makedirs(savedir, exist_ok=True)
+        index_path = os.path.join(savedir, 'heatmaps-index.csv')
+        if lines is None:
+            lines = range(1, self.max_lines + 1)
+
+        # hashes of the last export
+        previous = {}
+        if os.path.isfile(index_path):
+            previous_index = pd.read_csv(index_path, keep_default_na=False)
+            previous = dict(zip(previous_index['figure'], previous_index['hash']))
+
+        # the pivots are made here (they are cached, or come from the tensors) and sent to the processes
+        rows = []
+        arguments = []
+        for n_patterns, mixing_range, line in itertools.product(self.int_n_patterns, self.float_mixing_ranges, lines):
+            figure = os.path.join(savedir, f'P-{n_patterns}_range-{mixing_range}_line-{line}.' + save_as)
+            data, limits, title = self.heatmap_data(n_patterns=n_patterns, mixing_range=mixing_range, line=line)
+            data_hash = heatmap_hash(data, limits, title)
+            render = force or previous.get(figure) != data_hash or not os.path.isfile(figure)
+            rows.append({'P': n_patterns, 'range': mixing_range, 'line': line, 'figure': figure, 'hash': data_hash, 'render': render})
+            if render:
+                arguments.append((figure, save_as, dpi, title, data, limits, self.sigmas, self.deltas))
+        jobs = pd.DataFrame(rows, columns=['P', 'range', 'line', 'figure', 'hash', 'render'])
+        print(f"{len(arguments)} of {jobs.shape[0]} figures to make in {savedir}")
+
+        statuses = []
+        with ProcessPoolExecutor(max_workers=workers, initializer=init_heatmap_worker) as executor:
+            results = executor.map(render_heatmaps, arguments, chunksize=max(1, len(arguments) // (8 * (workers or os.cpu_count() or 1))))
+            for render in jobs['render']:
+                statuses.append(next(results) if render else ('up to date', 0.0))
+        jobs['status'] = [status for status, _ in statuses]
+        jobs['seconds'] = [seconds for _, seconds in statuses]
+        jobs = jobs.drop(columns='render')
+
+        # a failed figure is made again next time
+        jobs.loc[jobs['status'].str.startswith('failed'), 'hash'] = ''
+        jobs.to_csv(index_path, index=False)
+        print(jobs['status'].value_counts().to_string())
+        return jobs
+
+    def set_frame_cache(self, frame_cache_size: int=64, disk_cache: bool=False, frame_dpi: int=80, frame_style: str='seaborn'):
+        """
+        Sets how many frames (png images of slider_image) are kept in memory, this also empties the cache.
+        With disk_cache the frames are also saved in a "frames" folder in the simulation directory, so they are
+        still there after a restart of the kernel (a frame is made again if its data changed).
+        frame_style='seaborn' draws the frames as plot_heatmap_overlap_fluctuations_whichmax_3 (with the numbers of which max),
+        'fast' as export_heatmaps (draw_heatmaps: images without the numbers of which max, several times faster to make).
+        """
+        if frame_style not in ('seaborn', 'fast'):
+            raise ValueError(Simulation.purple(f"frame_style must be 'seaborn' or 'fast', not {frame_style!r}"))
+        self.frame_style = frame_style
+        self.frame_cache_size = frame_cache_size
+        self.frame_disk_cache = os.path.join(self.dir, 'frames') if disk_cache else None
+        self.frame_dpi = frame_dpi
+        self._frame_figure = {}
+        self._frame_cache = functools.lru_cache(maxsize=frame_cache_size)(lambda *key: self._render_frame(*key))  # as in set_pivot_cache_size
+
+    def get_frame(self, n_patterns: int, mixing_range: float, line: int) -> bytes:
+        """
+        Returns the png image of the figure of heatmap_data (the same quantities as plot_heatmap_overlap_fluctuations_whichmax_3)
+        for the selected number of patterns, range and line, from the cache if it is there.
+        """
+        with self._prefetch_condition:
+            self._last_frame_request = time.monotonic()
+        return self._frame_cache(n_patterns, mixing_range, line)
+
+    def _render_frame(self, n_patterns: int, mixing_range: float, line: int) -> bytes:
+        data, limits, title = self.heatmap_data(n_patterns=n_patterns, mixing_range=mixing_range, line=line)
+
+        if self.frame_disk_cache:
+            name = f'P-{n_patterns}_range-{mixing_range}_line-{line}_dpi-{self.frame_dpi}_{self.frame_style}'
+            path = os.path.join(self.frame_disk_cache, f'{name}_{heatmap_hash(data, limits, title)[:16]}.png')
+            if os.path.isfile(path):
+                with open(path, 'rb') as file:
+                    return file.read()
+
+        # drawn by one thread at a time
+        with self._frame_lock:
+            buffer = io.BytesIO()
+            if self.frame_style == 'seaborn':
+                # a new figure outside pyplot (it is never shown), with the panels of plot_heatmap_overlap_fluctuations_whichmax_3
+                from matplotlib.figure import Figure
+                figure = Figure(figsize=(15, 9))
+                self.draw_heatmap_panels(n_patterns=n_patterns, mixing_range=mixing_range, line=line,
+                                         ax=figure.subplots(2, 3, sharex=True, sharey=True))
+                figure.tight_layout()
+            else:
+                # one figure for all the frames
+                figure = draw_heatmaps(self._frame_figure, data, limits, title, self.sigmas, self.deltas)
+            figure.savefig(buffer, format='png', dpi=self.frame_dpi)
+        frame = buffer.getvalue()
+
+        if self.frame_disk_cache:
+            os.makedirs(self.frame_disk_cache, exist_ok=True)
+            # frames of the same P, range and line made from older data
+            for old_frame in glob.glob(os.path.join(glob.escape(self.frame_disk_cache), glob.escape(name) + '_*.png')):
+                os.remove(old_frame)
+            with open(path + '.tmp', 'wb') as file:
+                file.write(frame)
+            os.replace(path + '.tmp', path)
+        return frame
+
+    def prefetch_frames(self, n_patterns: int, mixing_range: float, line: int, delay: float=0.3):
+        """
+        Makes, in a background thread, the frames next to the selected one (the nearby lines first, then the nearby
+        ranges and numbers of patterns), so moving the sliders of slider_image finds them in the cache.
+        The thread works only when no frame has been asked with get_frame for 'delay' seconds, and a new call
+        replaces the frames still to be made.
+        """
+        p_index = self.int_n_patterns.index(n_patterns)
+        range_index = self.float_mixing_ranges.index(mixing_range)
+        keys = []
+        for step in (1, -1, 2, -2, 3, -3, 4, -4):
+            if 1 <= line + step <= self.max_lines:
+                keys.append((n_patterns, mixing_range, line + step))
+        for step in (1, -1):
+            if 0 <= range_index + step < len(self.float_mixing_ranges):
+                keys.append((n_patterns, self.float_mixing_ranges[range_index + step], line))
+            if 0 <= p_index + step < len(self.int_n_patterns):
+                keys.append((self.int_n_patterns[p_index + step], mixing_range, line))
+        # do not push out of the cache the frames around the selected one
+        keys = keys[:max(self.frame_cache_size // 2, 0)]
+
+        with self._prefetch_condition:
+            self._prefetch_keys = keys
+            self._prefetch_delay = delay
+            self._prefetch_condition.notify()
+            if self._prefetch_thread is None:
+                self._prefetch_thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+                self._prefetch_thread.start()
+
+    def _prefetch_loop(self):
+        while True:
+            with self._prefetch_condition:
+                if not self._prefetch_keys:
+                    # a new thread is started by the next call of prefetch_frames
+                    self._prefetch_thread = None
+                    return
+                wait = self._last_frame_request + self._prefetch_delay - time.monotonic()
+                if wait > 0:
+                    self._prefetch_condition.wait(wait)
+                    continue
+                key = self._prefetch_keys.pop(0)
+            try:
+                self._frame_cache(*key)
+            except Exception as error:
+                print(Simulation.purple(f"prefetch of the frame {key} failed: {error!r}"))
+
     def slider_image(self):
         """
         Makes an interactive plot with three sliders, for the line (counting from the last one), range and number of patterns.
-        It plots whatever "plot_heatmap_overlap_fluctuations_whichmax_3" plots; 
-        change this function to make it plot whatever you want
+        It shows the figure of "plot_heatmap_overlap_fluctuations_whichmax_3" (change draw_heatmap_panels to make it plot
+        whatever you want), or with frame_style='fast' the faster images of draw_heatmaps, as images from get_frame:
+        frames already seen are in the cache and the ones next to the selected one are made in the background (prefetch_frames).
         """
-        def auxiliary_function(n_patterns: int, mixing_range: float, line: int):
-            # not return anything, it plots an image
-            self.plot_heatmap_overlap_fluctuations_whichmax_3(n_patterns=n_patterns, mixing_range=mixing_range, line=line)
+        import ipywidgets as widgets
+        from IPython.display import display
 
         # Make the sliders
         p_slider = widgets.SelectionSlider(
@@ -583,14 +1197,180 @@ class Simulation:
             style={'description_width': 'initial'}
         )
 
-        # Make the interactive plot
-        interactive_plot = widgets.interactive_output(
-            auxiliary_function,
-            {'n_patterns': p_slider, 'mixing_range': range_slider, 'line': line_slider}
-        )
+        # Make the image, updated every time a slider moves
+        image = widgets.Image(format='png')
+        def update_image(change=None):
+            n_patterns, mixing_range, line = p_slider.value, range_slider.value, line_slider.value
+            image.value = self.get_frame(n_patterns=n_patterns, mixing_range=mixing_range, line=line)
+            self.prefetch_frames(n_patterns=n_patterns, mixing_range=mixing_range, line=line)
+        for slider in (p_slider, range_slider, line_slider):
+            slider.observe(update_image, names='value')
+        update_image()
+        # with follow=True refresh shows the new data
+        self._refresh_views.append(update_image)
+
         title = "<h3>" + self.simulation_name + "</h3>"
         title_widget = widgets.HTML(value=title)
-        display(title_widget, p_slider, range_slider, line_slider, interactive_plot)
+        display(title_widget, p_slider, range_slider, line_slider, image)
+
+# quantities, titles and colormaps of the figures of export_heatmaps (same as plot_heatmap_overlap_fluctuations_whichmax_3)
+heatmap_panels = {
+    'max overlap': ('Overlap', 'coolwarm'),
+    'fluctuations': ('Fluctuations', 'coolwarm'),
+    'rate': ('Rate  [#spikes / (tmax-tmin)]', 'coolwarm'),
+    'overlap pattern 0': ('Overlap pattern 0', 'coolwarm'),
+    'which_max': ('Which max', 'Spectral'),
+}
+
+# figure of the worker process of export_heatmaps, made by the first call of render_heatmaps and reused
+heatmap_figure = {}
+
+def heatmap_hash(data: dict, limits: dict, title: str) -> str:
+    """
+    Hash of the data, color limits and title of a figure of export_heatmaps
+    """
+    digest = hashlib.sha1(title.encode())
+    for what in heatmap_panels:
+        digest.update(np.ascontiguousarray(data[what]).tobytes())
+        digest.update(repr(limits[what]).encode())
+    return digest.hexdigest()
+
+def init_heatmap_worker():
+    """
+    Initializer of the processes of export_heatmaps: non-interactive backend
+    """
+    import matplotlib
+    matplotlib.use('Agg')
+
+def draw_heatmaps(state: dict, data: dict, limits: dict, title: str, sigmas: list, deltas: list):
+    """
+    Draws the data of heatmap_data on the figure kept in state (an empty dictionary the first time) and returns the figure.
+    The figure and its images are made the first time and then only their data, color limits and title are changed.
+    The figure is not managed by pyplot, so it is never shown and can be kept as long as needed.
+    """
+    import matplotlib
+    from matplotlib.figure import Figure
+
+    key = (tuple(sigmas), tuple(deltas), limits['fluctuations'])
+    if state.get('key') != key:
+        fig = Figure(figsize=(15,9))
+        ax = fig.subplots(2, 3, sharex=True, sharey=True)
+        images = {}
+        for what, axis in zip(heatmap_panels, [ax[0,0], ax[0,1], ax[0,2], ax[1,0], ax[1,1]]):
+            panel_title, cmap = heatmap_panels[what]
+            # the fluctuations have the same (logarithmic) limits in the whole sweep
+            norm = matplotlib.colors.LogNorm(*limits[what]) if what == 'fluctuations' else None
+            images[what] = axis.imshow(np.full((len(deltas), len(sigmas)), np.nan), cmap=cmap, norm=norm,
+                                       origin='lower', aspect='auto', interpolation='nearest')
+            fig.colorbar(images[what], ax=axis)
+            axis.set_title(panel_title)
+            axis.set_xticks(range(len(sigmas)), [f'{sigma:g}' for sigma in sigmas], rotation=90)
+            axis.set_yticks(range(len(deltas)), [f'{delta:g}' for delta in deltas])
+            axis.set_xlabel('sigma')
+            axis.set_ylabel('delta')
+        ax[1,2].axis('off')
+        state.update({'key': key, 'fig': fig, 'images': images, 'title': fig.suptitle('')})
+        fig.tight_layout()
+
+    for what, image in state['images'].items():
+        image.set_data(data[what])
+        if what != 'fluctuations':
+            image.set_clim(*limits[what])
+    state['title'].set_text(title)
+    return state['fig']
+
+def render_heatmaps(arguments):
+    """
+    Saves a single figure of export_heatmaps, in the worker processes, reusing the figure of the process.
+    Returns the status ('rendered' or the error) and the time it took.
+    """
+    figure, save_as, dpi, title, data, limits, sigmas, deltas = arguments
+    time_start = time.perf_counter()
+    try:
+        draw_heatmaps(heatmap_figure, data, limits, title, sigmas, deltas).savefig(figure, format=save_as, dpi=dpi)
+        status = 'rendered'
+    except Exception as error:
+        status = f'failed: {error!r}'
+        print(Simulation.purple(f"{figure}: {status}"))
+    return status, time.perf_counter() - time_start
+
+def read_feather_columns(path: str, columns: List[str]=None) -> pd.DataFrame:
+    """
+    Reads a feather file (only the selected columns if columns is not None) in a dataframe with one block for each column,
+    so that a dataframe with some of its columns (like q3_merged_df_light) uses the same memory instead of a copy.
+    """
+    import pyarrow.feather as feather
+    return feather.read_table(path, columns=columns).to_pandas(split_blocks=True, self_destruct=True)
+
+def connessioni_cache_path(path: str, suffix: str) -> str:
+    """
+    Path of a binary version of a CONNESSIONI file, in the same directory.
+    The name must not start with "CONNESSIONI" otherwise extract_connessioni_file would find more than one file.
+    """
+    directory, name = os.path.split(path)
+    return os.path.join(directory, 'binary-' + name + suffix)
+
+def load_connessioni_matrix(path: str) -> np.ndarray:
+    """
+    Memory maps the float32 .npy version of a CONNESSIONI file, making it first if it is missing or older than the text file.
+    It is outside the class so that it can be used in worker processes.
+    """
+    dense_path = connessioni_cache_path(path, '.npy')
+    if not Simulation.is_newer(dense_path, path):
+        matrix = pd.read_csv(path, sep=r'\s+', header=None, dtype=np.float32).to_numpy()
+        np.save(dense_path, matrix)
+    return np.load(dense_path, mmap_mode='r')
+
+def connessioni_modularity(path: str) -> float:
+    """
+    Newman modularity of the (directed, weighted) connectivity matrix in a CONNESSIONI file,
+    with the neurons divided in modules of Z neurons (neuron i is in the site i // Z) and only the positive connections:
+    Q = sum over modules c of (A_cc / m - out_c * in_c / m^2), where A_cc is the sum of the connections inside c,
+    out_c and in_c the sums of the connections leaving and entering c and m the sum of all connections.
+    """
+    matrix = np.maximum(load_connessioni_matrix(path), 0).astype(np.float64)
+    number_neurons = matrix.shape[0]
+    Z = int(read_run_parameters(os.path.join(os.path.dirname(path), 'output-connessioni.txt'))['Z'])
+
+    # one-hot matrix of the modules, then the connections between modules
+    modules = np.arange(number_neurons) // Z
+    one_hot = np.zeros((number_neurons, modules[-1] + 1))
+    one_hot[np.arange(number_neurons), modules] = 1
+    between_modules = one_hot.T @ matrix @ one_hot
+
+    m = between_modules.sum()
+    out_strength = between_modules.sum(axis=1)
+    in_strength = between_modules.sum(axis=0)
+    return np.trace(between_modules) / m - (out_strength * in_strength).sum() / m ** 2
+
+# seconds, import of simulation_class in a new python process (pandas alone takes about half a second)
+import_time_budget = 1.5
+# libraries that must not be imported with simulation_class
+plotting_modules = ['matplotlib', 'seaborn', 'ipywidgets', 'IPython']
+
+def import_time(budget: float=import_time_budget) -> float:
+    """
+    Measures the cold import of simulation_class, in a new python process, and returns it in seconds.
+    Raises an error if it takes more than budget seconds or if it imports any of plotting_modules.
+    """
+    code = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        "import simulation_class\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(m for m in {plotting_modules!r} if m in sys.modules))\n"
+    )
+    result = subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)),
+                            capture_output=True, text=True, check=True)
+    seconds, imported = result.stdout.split('\n')[:2]
+    seconds = float(seconds)
+    print(f"import simulation_class: {seconds:.3f} s (budget {budget} s)")
+
+    if imported:
+        raise RuntimeError(Simulation.purple(f"import simulation_class also imports {imported}"))
+    if seconds > budget:
+        raise RuntimeError(Simulation.purple(f"import simulation_class takes {seconds:.3f} s, more than {budget} s"))
+    return seconds
 
 def test() -> None:
     """Useless as of right now, I used it with my old test simulation"""
@@ -599,4 +1379,5 @@ def test() -> None:
 
 if __name__ == "__main__":
     test()
+    import_time()
     
\ No newline at end of file
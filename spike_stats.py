@@ -0,0 +1,234 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+from catalog import file_kind
+from spike_store import iter_spike_chunks, store_path, is_up_to_date
+from dat_reader import read_run_parameters
+from rewindow import find_runs
+
+# Statistics of the spike trains of every run, computed in a single pass over the spikes3 files (or their .spk stores),
+# one chunk at a time, so the memory depends on the number of neurons and on the chunk size and not on the file.
+# For each neuron only running sums are kept (spikes, sum and sum of squares of the ISIs and of the spike counts in
+# bins of bin_size ms, time of the last spike), and the chunks are reduced with np.bincount / np.unique by neuron.
+# Tables (times are in ms, rates in Hz, only the spikes with time_ini <= time < time_fin are used):
+#   neurons  one row per neuron: spikes, rate, mean ISI, CV of the ISIs, Fano factor of the counts in the bins
+#   modules  one row per module (neurons neuron // zeta, zeta is Z of the output file by default, like the zones of
+#            the rasters): mean rate and CV of its neurons, Fano factor of the counts of the module, synchrony
+#   runs     one row per run: the same averaged on all the neurons, with the synchrony of the whole network
+#   isi      histogram of all the ISIs of each run, with the bins of isi_bins
+# Synchrony is the chi of Golomb and Rinzel: sqrt(variance of the mean count / mean of the variances of the counts),
+# 1 when all the neurons fire together and about 1/sqrt(N) for N independent neurons.
+# Every row has P, range, sigma, delta, alpha, so the tables can be joined with the q3 data (Simulation.join_spike_stats).
+
+run_columns = ['P', 'range', 'sigma', 'delta', 'alpha']
+stats_tables = ['runs', 'modules', 'neurons', 'isi']
+
+# ISI bins of the histograms in ms, logarithmic from 0.1 ms to 10 s
+isi_bins = np.logspace(-1, 4, 51)
+
+def spike_stats_file(
+        spike_file: str,
+        output_file: str,
+        number_patterns: int,
+        mixing_range: float,
+        bin_size: float=10,
+        time_ini: float=0,
+        time_fin: float=None,
+        number_neurons: int=None,
+        zeta: int=None,
+        chunksize: int=1_000_000
+        ) -> dict:
+    """
+    Computes the tables at the top of this file for a single run, reading the spikes3 file (or its .spk store
+    if it is up to date) in chunks of 'chunksize' spikes.
+    time_fin defaults to tmax of the output file, number_neurons to S * Z and zeta to Z.
+    Returns a dictionary {table name: dataframe}.
+    """
+    parameters = read_run_parameters(output_file)
+    time_fin = float(parameters['tmax']) if time_fin is None else time_fin
+    zeta = int(parameters['Z']) if zeta is None else zeta
+    if number_neurons is None:
+        number_neurons = int(parameters['S']) * int(parameters['Z']) if 'S' in parameters and 'Z' in parameters else 0
+    number_bins = int((time_fin - time_ini) // bin_size)
+    duration = (time_fin - time_ini) / 1000  # s
+
+    store = store_path(spike_file)
+    source = store if is_up_to_date(store, os.stat(spike_file)) else spike_file
+
+    # running sums by neuron (made longer if a neuron is larger than expected), module and bin
+    sums = {name: np.zeros(number_neurons) for name in ['spikes', 'isi count', 'isi sum', 'isi sum2', 'bin sum', 'bin sum2']}
+    last_spike = np.full(number_neurons, np.nan)
+    # sums of the squares of the counts in the bins of each module and of the whole network
+    squares = {'module': np.zeros(0), 'population': 0.0}
+    isi_histogram = np.zeros(isi_bins.shape[0] - 1)
+    # spikes of the last bin of the previous chunk, the bin may continue in the next chunk
+    carry_neurons = np.empty(0, dtype=np.int64)
+    carry_bins = np.empty(0, dtype=np.int64)
+
+    for chunk in iter_spike_chunks(source, chunksize=chunksize):
+        times = np.asarray(chunk['time'], dtype=np.float64)
+        neurons = np.asarray(chunk['neuron'], dtype=np.int64)
+        inside = (times >= time_ini) & (times < time_fin)
+        times, neurons = times[inside], neurons[inside]
+        if not times.shape[0]:
+            continue
+
+        if neurons.max() >= last_spike.shape[0]:
+            grow = neurons.max() + 1 - last_spike.shape[0]
+            sums = {name: np.concatenate([values, np.zeros(grow)]) for name, values in sums.items()}
+            last_spike = np.concatenate([last_spike, np.full(grow, np.nan)])
+        size = last_spike.shape[0]
+        sums['spikes'] += np.bincount(neurons, minlength=size)
+
+        # ISIs: the spikes sorted by neuron (stable, so still by time inside each neuron)
+        order = np.argsort(neurons, kind='stable')
+        sorted_neurons, sorted_times = neurons[order], times[order]
+        same = sorted_neurons[1:] == sorted_neurons[:-1]
+        firsts = np.flatnonzero(np.concatenate([[True], ~same]))
+        lasts = np.concatenate([firsts[1:] - 1, [sorted_neurons.shape[0] - 1]])
+        isi = np.concatenate([(sorted_times[1:] - sorted_times[:-1])[same], sorted_times[firsts] - last_spike[sorted_neurons[firsts]]])
+        isi_neurons = np.concatenate([sorted_neurons[1:][same], sorted_neurons[firsts]])
+        # the first spike of a neuron has no ISI
+        valid = ~np.isnan(isi)
+        isi, isi_neurons = isi[valid], isi_neurons[valid]
+        sums['isi count'] += np.bincount(isi_neurons, minlength=size)
+        sums['isi sum'] += np.bincount(isi_neurons, weights=isi, minlength=size)
+        sums['isi sum2'] += np.bincount(isi_neurons, weights=isi ** 2, minlength=size)
+        isi_histogram += np.histogram(isi, bins=isi_bins)[0]
+        last_spike[sorted_neurons[lasts]] = sorted_times[lasts]
+
+        # counts in the bins: the last bin of the chunk is kept for the next chunk
+        bins = ((times - time_ini) // bin_size).astype(np.int64)
+        bins = np.concatenate([carry_bins, bins])
+        neurons = np.concatenate([carry_neurons, neurons])
+        complete = bins < bins[-1]
+        carry_bins, carry_neurons = bins[~complete], neurons[~complete]
+        add_bin_counts(bins[complete], neurons[complete], number_bins, zeta, sums, squares)
+
+    add_bin_counts(carry_bins, carry_neurons, number_bins, zeta, sums, squares)
+
+    sigma, delta, alpha = file_kind(os.path.basename(spike_file))[1:]
+    run = {'P': np.int64(number_patterns), 'range': float(mixing_range), 'sigma': sigma, 'delta': delta, 'alpha': alpha}
+
+    # neurons
+    size = last_spike.shape[0]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        isi_mean = sums['isi sum'] / sums['isi count']
+        isi_cv = np.sqrt(np.maximum(sums['isi sum2'] / sums['isi count'] - isi_mean ** 2, 0)) / isi_mean
+        # counts of the spikes in complete bins only (the last bin may be shorter)
+        bin_mean = sums['bin sum'] / number_bins
+        bin_variance = np.maximum(sums['bin sum2'] / number_bins - bin_mean ** 2, 0)
+        fano = bin_variance / bin_mean
+    neurons_df = pd.DataFrame({
+        'neuron': np.arange(size, dtype=np.int64),
+        'module': np.arange(size, dtype=np.int64) // zeta,
+        'spikes': sums['spikes'].astype(np.int64),
+        'rate': sums['spikes'] / duration,
+        'ISI mean': isi_mean,
+        'ISI CV': isi_cv,
+        'Fano': fano,
+    })
+
+    # modules
+    number_modules = (size + zeta - 1) // zeta
+    module_sum2 = np.concatenate([squares['module'], np.zeros(number_modules - squares['module'].shape[0])])
+    module_mean = np.bincount(neurons_df['module'], weights=bin_mean, minlength=number_modules)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        module_variance = np.maximum(module_sum2 / number_bins - module_mean ** 2, 0)
+        module_neurons = np.bincount(neurons_df['module'], minlength=number_modules)
+        modules_df = neurons_df.groupby('module').agg(**{
+            'neurons': ('neuron', 'size'),
+            'spikes': ('spikes', 'sum'),
+            'rate': ('rate', 'mean'),
+            'ISI CV': ('ISI CV', 'mean'),
+        }).reset_index()
+        modules_df['Fano'] = module_variance / module_mean
+        # the variance of the mean count of the module is variance / neurons^2
+        mean_neuron_variance = np.bincount(neurons_df['module'], weights=bin_variance, minlength=number_modules) / module_neurons
+        modules_df['synchrony'] = np.sqrt(module_variance / module_neurons ** 2 / mean_neuron_variance)
+
+        # whole network
+        population_mean = sums['bin sum'].sum() / number_bins
+        population_variance = max(squares['population'] / number_bins - population_mean ** 2, 0)
+        runs_df = pd.DataFrame([{
+            'neurons': size,
+            'active neurons': int((sums['spikes'] > 0).sum()),
+            'spikes': int(sums['spikes'].sum()),
+            'rate': float(neurons_df['rate'].mean()),
+            'ISI CV': float(neurons_df['ISI CV'].mean()),
+            'Fano': float(neurons_df['Fano'].mean()),
+            'synchrony': float(np.sqrt(population_variance / size ** 2 / bin_variance.mean())),
+        }])
+
+    isi_df = pd.DataFrame({'ISI': isi_bins[:-1], 'ISI right': isi_bins[1:], 'count': isi_histogram.astype(np.int64)})
+
+    tables = {'runs': runs_df, 'modules': modules_df, 'neurons': neurons_df, 'isi': isi_df}
+    for df in tables.values():
+        for i, column in enumerate(run_columns):
+            df.insert(i, column, run[column])
+    return tables
+
+def add_bin_counts(bins: np.ndarray, neurons: np.ndarray, number_bins: int, zeta: int, sums: dict, squares: dict):
+    """
+    Adds the spikes of complete bins to the sums of spike_stats_file: counts and squares of the counts in the bins of each
+    neuron, squares of the counts of each module and of the whole network. Spikes after the last complete bin are not counted.
+    """
+    complete = bins < number_bins
+    bins, neurons = bins[complete], neurons[complete]
+    if not bins.shape[0]:
+        return
+
+    # counts of each (bin, neuron) pair
+    keys, counts = np.unique(bins * (1 << 32) + neurons, return_counts=True)
+    size = sums['bin sum'].shape[0]
+    sums['bin sum'] += np.bincount(keys & 0xFFFFFFFF, weights=counts.astype(np.float64), minlength=size)
+    sums['bin sum2'] += np.bincount(keys & 0xFFFFFFFF, weights=counts.astype(np.float64) ** 2, minlength=size)
+
+    keys, counts = np.unique(bins * (1 << 32) + neurons // zeta, return_counts=True)
+    module_squares = np.bincount(keys & 0xFFFFFFFF, weights=counts.astype(np.float64) ** 2)
+    if module_squares.shape[0] > squares['module'].shape[0]:
+        squares['module'] = np.concatenate([squares['module'], np.zeros(module_squares.shape[0] - squares['module'].shape[0])])
+    squares['module'][:module_squares.shape[0]] += module_squares
+
+    counts = np.unique(bins, return_counts=True)[1].astype(np.float64)
+    squares['population'] += (counts ** 2).sum()
+
+def spike_stats_simulation(
+        simulation_dir: str,
+        simulation_name: str,
+        workers: int=None,
+        save: bool=True,
+        **kwargs
+        ) -> dict:
+    """
+    Computes the spike statistics of all the runs of a simulation with spike_stats_file (kwargs are passed to it),
+    in a pool of 'workers' processes. Returns a dictionary {table name: dataframe of all the runs}.
+    If save is True each table is saved as "spike-stats-{table}-{simulation_name}.feather" in the simulation
+    directory (read by Simulation.read_spike_stats).
+    """
+    runs = find_runs(simulation_dir)
+    if not runs:
+        raise ValueError(purple(f"No spikes3 file found in {simulation_dir}"))
+    print(f"{len(runs)} spikes3 files")
+
+    keys = ['spike_file', 'output_file', 'number_patterns', 'mixing_range']
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(spike_stats_file, **{key: run[key] for key in keys}, **kwargs) for run in runs]
+        results = [future.result() for future in futures]
+
+    tables = {table: pd.concat([result[table] for result in results], ignore_index=True) for table in stats_tables}
+    if save:
+        for table, df in tables.items():
+            df.to_feather(os.path.join(simulation_dir, f'spike-stats-{table}-{simulation_name}.feather'))
+        print(f"Saved the spike statistics in {simulation_dir}")
+    return tables
+
+def purple(string: str):
+    return "\033[95m" + string + "\033[0m"
+
+
+if __name__ == "__main__":
+    spike_stats_simulation(simulation_dir=r'./example_simulation', simulation_name='example_simulation')
@@ -0,0 +1,164 @@
+import os
+import json
+
+import pandas as pd
+import numpy as np
+
+from dat_reader import iter_dat_chunks
+
+# Binary columnar version of the spikes3 files.
+# A file "spikes3-1-0-0.5.dat" is converted to a folder "spikes3-1-0-0.5.spk" containing:
+#   time.bin       float64, time of each spike (increasing)
+#   cue.bin        uint8, 1 if the spike is a cue spike
+#   neuron.bin     uint16 or uint32, id of the neuron
+#   pattern-k.bin  uint16 or uint32, index of the neuron in the order of pattern k (one file for each pattern)
+#   index.bin      float64, time of the spikes number 0, index_step, 2*index_step, ...
+#   meta.json      number of spikes, number of patterns, dtype of the neurons, index_step and info on the source file
+# All the columns are read with np.memmap, so reading a time window does not copy anything.
+
+store_extension = '.spk'
+
+def store_path(spike_file: str) -> str:
+    """
+    Returns the path of the binary store of a spikes3 .dat file
+    """
+    return os.path.splitext(spike_file)[0] + store_extension
+
+def convert_spikes(spike_file: str, chunksize: int=1_000_000, index_step: int=4096, force: bool=False) -> str:
+    """
+    Converts a spikes3 .dat file to the binary columnar store (see the top of this file), reading it in chunks.
+    The conversion is skipped if the store is already there and up to date, unless force is True.
+    Returns the path of the store.
+    """
+    store = store_path(spike_file)
+    source_stat = os.stat(spike_file)
+    if not force and is_up_to_date(store, source_stat):
+        return store
+    os.makedirs(store, exist_ok=True)
+
+    n_spikes = 0
+    n_patterns = None
+    max_neuron = 0
+    files = {}
+    try:
+        for values in iter_dat_chunks(spike_file, chunksize=chunksize):
+            if n_patterns is None:
+                n_patterns = values.shape[1] - 3
+                # the neurons are written as uint32, they are made smaller at the end if possible
+                names = ['time', 'cue', 'neuron'] + [f'pattern-{k}' for k in range(n_patterns)]
+                files = {name: open(os.path.join(store, name + '.bin'), 'wb') for name in names}
+            files['time'].write(values[:, 0].astype(np.float64).tobytes())
+            files['cue'].write(values[:, 1].astype(np.uint8).tobytes())
+            neurons = values[:, 2:].astype(np.uint32)
+            files['neuron'].write(neurons[:, 0].tobytes())
+            for k in range(n_patterns):
+                files[f'pattern-{k}'].write(neurons[:, k + 1].tobytes())
+            max_neuron = max(max_neuron, int(neurons.max()))
+            n_spikes += values.shape[0]
+    finally:
+        for file in files.values():
+            file.close()
+
+    if n_patterns is None:
+        raise ValueError(purple(f"convert_spikes: {spike_file} is empty"))
+
+    # use uint16 for the neurons when possible
+    neuron_dtype = np.uint16 if max_neuron <= np.iinfo(np.uint16).max else np.uint32
+    if neuron_dtype == np.uint16:
+        for name in ['neuron'] + [f'pattern-{k}' for k in range(n_patterns)]:
+            path = os.path.join(store, name + '.bin')
+            np.fromfile(path, dtype=np.uint32).astype(np.uint16).tofile(path)
+
+    # sparse index: time of one spike every index_step
+    times = np.memmap(os.path.join(store, 'time.bin'), dtype=np.float64, mode='r', shape=(n_spikes,))
+    np.array(times[::index_step]).tofile(os.path.join(store, 'index.bin'))
+    del times
+
+    meta = {
+        'n_spikes': n_spikes,
+        'n_patterns': n_patterns,
+        'neuron_dtype': np.dtype(neuron_dtype).name,
+        'index_step': index_step,
+        'source': os.path.basename(spike_file),
+        'source_size': source_stat.st_size,
+        'source_mtime': source_stat.st_mtime_ns,
+    }
+    # meta.json is written last, so a store without it is incomplete
+    with open(os.path.join(store, 'meta.json'), 'w') as file:
+        json.dump(meta, file, indent=4)
+
+    print(f"converted {spike_file} to {store} ({n_spikes} spikes)")
+    return store
+
+def is_up_to_date(store: str, source_stat) -> bool:
+    """
+    True if the store exists and was made from a file with the same size and modification time
+    """
+    meta_path = os.path.join(store, 'meta.json')
+    if not os.path.isfile(meta_path):
+        return False
+    with open(meta_path) as file:
+        meta = json.load(file)
+    return meta['source_size'] == source_stat.st_size and meta['source_mtime'] == source_stat.st_mtime_ns
+
+def load_spikes(store: str, time_ini=0, time_fin=np.inf) -> dict:
+    """
+    Returns a dictionary {'time', 'cue', 'neuron', 'pattern-0', ...} of memory mapped arrays with only the spikes with
+    time_ini <= time <= time_fin. The arrays are views of the files, nothing is copied.
+    The window is found with the sparse index first and then inside the time column.
+    """
+    with open(os.path.join(store, 'meta.json')) as file:
+        meta = json.load(file)
+    n_spikes = meta['n_spikes']
+    index_step = meta['index_step']
+    neuron_dtype = np.dtype(meta['neuron_dtype'])
+
+    times = np.memmap(os.path.join(store, 'time.bin'), dtype=np.float64, mode='r', shape=(n_spikes,))
+    index = np.fromfile(os.path.join(store, 'index.bin'), dtype=np.float64)
+
+    # blocks of the index that contain the limits of the window
+    block_ini = max(np.searchsorted(index, time_ini, side='left') - 1, 0) * index_step
+    block_fin = min(np.searchsorted(index, time_fin, side='right') * index_step, n_spikes)
+    first = block_ini + np.searchsorted(times[block_ini:block_fin], time_ini, side='left')
+    last = block_ini + np.searchsorted(times[block_ini:block_fin], time_fin, side='right')
+
+    columns = {'time': times[first:last]}
+    columns['cue'] = np.memmap(os.path.join(store, 'cue.bin'), dtype=np.uint8, mode='r', shape=(n_spikes,))[first:last]
+    for name in ['neuron'] + [f'pattern-{k}' for k in range(meta['n_patterns'])]:
+        column = np.memmap(os.path.join(store, name + '.bin'), dtype=neuron_dtype, mode='r', shape=(n_spikes,))
+        columns[name] = column[first:last]
+    return columns
+
+def read_spike_store(store: str, time_ini=0, time_fin=np.inf) -> pd.DataFrame:
+    """
+    Same as load_spikes but returns a dataframe with the same columns of a spikes3 file (time, cue, neuron, one column for each pattern)
+    """
+    columns = load_spikes(store, time_ini=time_ini, time_fin=time_fin)
+    return pd.DataFrame(columns, copy=False)
+
+def iter_spike_chunks(spike_file: str, chunksize: int=1_000_000):
+    """
+    Yields the spikes of a spikes3 .dat file or of a store (.spk) in chunks of at most 'chunksize' spikes,
+    as dictionaries of arrays like the ones from load_spikes ('time', 'cue', 'neuron', 'pattern-0', ...).
+    Only one chunk at a time is in memory.
+    """
+    if os.path.splitext(spike_file)[1] == store_extension:
+        columns = load_spikes(spike_file)
+        for first in range(0, len(columns['time']), chunksize):
+            yield {name: column[first:first + chunksize] for name, column in columns.items()}
+        return
+
+    for values in iter_dat_chunks(spike_file, chunksize=chunksize):
+        columns = {'time': values[:, 0].astype(np.float64), 'cue': values[:, 1].astype(np.uint8)}
+        columns['neuron'] = values[:, 2].astype(np.uint32)
+        for k in range(values.shape[1] - 3):
+            columns[f'pattern-{k}'] = values[:, k + 3].astype(np.uint32)
+        yield columns
+
+def purple(string: str):
+    return "\033[95m" + string + "\033[0m"
+
+
+if __name__ == "__main__":
+    dir = r'/path/of/your/spikes3/file.dat'
+    convert_spikes(dir)
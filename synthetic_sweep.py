@@ -0,0 +1,217 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+# Writes fake sweeps with the same folders, file names and formats as the simulations, to test and benchmark
+# the code on sweeps of any size (see benchmark.py). For every (P, range) there is a folder "P-{P}--range-{range}"
+# with the files of the network (CONNESSIONI, PATTERN, sites3, matrice3) and, for every sigma, delta and alpha,
+# the files of a run (q3, spikes3, rate3, medie3, temp3 and output), plus a .log file next to the folder.
+# The numbers are not a simulation but they are consistent with each other: the spikes are Poisson spikes of
+# N = S * Z neurons with 'rate' Hz, rate3, medie3, temp3 and the number of spikes in q3 are calculated from them,
+# the overlaps of q3 grow with sigma and decrease with P. A fraction 'short_runs' of the runs stops early,
+# like the runs stopped by maxsp2, so their q3 files have less lines.
+
+def generate_sweep(
+        simulation_dir: str,
+        numbers_of_patterns: list=[2, 10, 20],
+        mixing_ranges: list=[1.0, 2.0, 2.5],
+        sigmas: list=[1, 5.5, 10],
+        deltas: list=[0, 1, 2],
+        alphas: list=[0.5],
+        S: int=10,  # sites
+        Z: int=50,  # neurons per site
+        G: int=5,  # sites of a pattern
+        K: int=25,  # neurons per site of a pattern
+        rate: float=8,  # Hz per neuron
+        tmax: int=300,
+        tmin: int=100,
+        flush: int=10,
+        flush2: int=20,
+        pout: int=20,
+        short_runs: float=0.1,
+        connessioni: bool=True,  # the CONNESSIONI file has N x N values, it can be big
+        seed: int=0,
+        workers: int=None
+        ) -> pd.DataFrame:
+    """
+    Writes a fake sweep (see the top of this file) in simulation_dir, one folder per process of a pool of 'workers'.
+    Returns a dataframe with P, range, number of runs, number of files and MB of each folder.
+    """
+    os.makedirs(simulation_dir, exist_ok=True)
+    parameters = {'S': S, 'Z': Z, 'G': G, 'K': K, 'rate': rate, 'tmax': tmax, 'tmin': tmin, 'flush': flush, 'flush2': flush2,
+                  'pout': pout, 'short_runs': short_runs, 'connessioni': connessioni}
+    runs = [(sigma, delta, alpha) for sigma in sigmas for delta in deltas for alpha in alphas]
+    arguments = []
+    for i, number_patterns in enumerate(numbers_of_patterns):
+        for j, mixing_range in enumerate(mixing_ranges):
+            run_dir = os.path.join(simulation_dir, f'P-{int(number_patterns)}--range-{float(mixing_range)}')
+            arguments.append((run_dir, int(number_patterns), float(mixing_range), runs, parameters, (seed, i, j)))
+
+    time_start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        rows = list(executor.map(write_run_dir, arguments))
+    summary = pd.DataFrame(rows)
+    print(f"generate_sweep: {summary['runs'].sum()} runs, {summary['files'].sum()} files, {summary['MB'].sum():.1f} MB "
+          f"in {time.perf_counter() - time_start:.1f} s")
+    return summary
+
+def write_run_dir(arguments) -> dict:
+    """
+    Writes the folder of a (P, range) with all its runs, arguments is a tuple like the ones made by generate_sweep.
+    It is a top level function so that it can be sent to the worker processes.
+    """
+    run_dir, number_patterns, mixing_range, runs, parameters, seed = arguments
+    rng = np.random.default_rng(seed)
+    S, Z, G, K = parameters['S'], parameters['Z'], parameters['G'], parameters['K']
+    N = S * Z
+    os.makedirs(run_dir, exist_ok=True)
+
+    # files of the network, named like "PATTERN6-10-50-5-25-10-2-0-1-random"
+    network_name = f'{S}-{Z}-{G}-{K}-{number_patterns}-2-0-1-random'
+    site_orders = np.array([rng.permutation(S) for _ in range(number_patterns)])
+    neuron_orders = np.array([rng.permutation(N) for _ in range(number_patterns)])
+    phases = np.sort(rng.uniform(-mixing_range, mixing_range, (number_patterns, N)), axis=1)
+    with open(os.path.join(run_dir, 'PATTERN6-' + network_name), 'w') as file:
+        write_table(file, site_orders, ' %d' * S + '\n')
+        write_table(file, np.full((1, S), G * K), ' %d' * S + '\n')
+        write_table(file, neuron_orders, ' %d' * N + '\n')
+        write_table(file, phases, ' %g' * N + '\n')
+    if parameters['connessioni']:
+        connections = np.where(rng.random((N, N)) < 0.3, 0, rng.normal(0, 0.15, (N, N)))
+        np.fill_diagonal(connections, 0)
+        with open(os.path.join(run_dir, 'CONNESSIONI6-' + network_name), 'w') as file:
+            write_table(file, connections, ' %g' * N + '\n', chunksize=1000)
+    with open(os.path.join(run_dir, f'sites3-{network_name}.txt'), 'w') as file:
+        write_table(file, np.column_stack([np.arange(G), rng.integers(0, S, (G, 2))]), '%5d%5d%5d\n')
+    with open(os.path.join(run_dir, f'matrice3-{network_name}.txt'), 'w') as file:
+        sites = np.array([(i, j) for i in range(S) for j in range(S)])
+        write_table(file, np.column_stack([sites, rng.normal(0, 100, (S * S, 2))]), '%6d %6d %12g %12g\n')
+
+    # position of each neuron in the order of each pattern, as in the spikes3 files
+    positions = np.argsort(neuron_orders, axis=1)
+
+    log_lines = []
+    for number, (sigma, delta, alpha) in enumerate(runs):
+        name = f'{sigma:g}-{delta:g}-{alpha:g}'
+        write_run(run_dir, name, number_patterns, mixing_range, sigma, delta, alpha, positions, parameters, rng)
+        log_lines.append(f"{time.strftime('%a %b %e %I:%M:%S %p UTC %Y')}: lanciato run {number + 1}/{len(runs)}... "
+                         f"output in {run_dir}//output-{name}.txt\n")
+    with open(run_dir + '.log', 'w') as file:
+        file.writelines(log_lines)
+
+    files = os.listdir(run_dir)
+    size = sum(os.path.getsize(os.path.join(run_dir, filename)) for filename in files)
+    return {'P': number_patterns, 'range': mixing_range, 'runs': len(runs), 'files': len(files), 'MB': size / 1e6}
+
+def write_run(run_dir, name, number_patterns, mixing_range, sigma, delta, alpha, positions, parameters, rng):
+    """
+    Writes the q3, spikes3, rate3, medie3, temp3 and output files of a single run
+    """
+    S, Z = parameters['S'], parameters['Z']
+    N = S * Z
+    tmax, tmin, flush, flush2, pout = (parameters[key] for key in ['tmax', 'tmin', 'flush', 'flush2', 'pout'])
+    observed = min(number_patterns, pout)
+
+    # the run may stop before tmax
+    stop = tmax
+    if rng.random() < parameters['short_runs']:
+        stop = int(rng.uniform(tmin + flush, tmax) // flush * flush)
+
+    # spikes: time, cue flag, neuron, position of the neuron in the first patterns
+    number_spikes = rng.poisson(N * parameters['rate'] * stop / 1000)
+    times = np.sort(rng.uniform(0, stop, number_spikes))
+    neurons = rng.integers(0, N, number_spikes)
+    cue = (times < 50) & (rng.random(number_spikes) < 0.2)
+    spikes = np.column_stack([times, cue, neurons, positions[:observed, neurons].T])
+    with open(os.path.join(run_dir, f'spikes3-{name}.dat'), 'w') as file:
+        write_table(file, spikes, '%20.15g%5d' + '%7d' * (observed + 1) + '\n')
+
+    # rate3: rate of each site in every ms
+    milliseconds = np.minimum(times.astype(np.int64), stop - 1)
+    site_counts = np.zeros((stop, S))
+    np.add.at(site_counts, (milliseconds, neurons // Z), 1)
+    with open(os.path.join(run_dir, f'rate3-{name}.dat'), 'w') as file:
+        write_table(file, np.column_stack([np.arange(1, stop + 1), site_counts / Z / 0.001]), '%8d' + ' %12g' * S + '\n')
+
+    # temp3 (last flush ms) and medie3 (from the start): rate in Hz, variance, CV and Fano of the spikes in a ms
+    counts = site_counts.sum(axis=1)
+    ends = np.arange(flush, stop + 1, flush)
+    for kind, starts in [('temp3', ends - flush), ('medie3', np.zeros(ends.shape[0], dtype=np.int64))]:
+        rows = []
+        for start, end in zip(starts, ends):
+            mean, variance = counts[start:end].mean(), counts[start:end].var()
+            with np.errstate(divide='ignore', invalid='ignore'):
+                rows.append((sigma, delta, alpha, end, mean / N / 0.001, variance, np.sqrt(variance) / np.float64(mean), variance / np.float64(mean)))
+        with open(os.path.join(run_dir, f'{kind}-{name}.dat'), 'w') as file:
+            write_table(file, np.array(rows), '%12g' + ' %12g' * 7 + '\n')
+
+    # q3: one line every flush ms, the overlaps are calculated from tmin
+    lines = np.arange(flush, stop + 1, flush)
+    started = lines > tmin
+    last_spike = np.concatenate([[0], times])[np.searchsorted(times, lines, side='right')]
+    spikes_in_window = np.where(started, np.searchsorted(times, lines, side='right') - np.searchsorted(times, tmin), 0)
+    recall = np.exp(-number_patterns / 20) / (1 + np.exp(5 - sigma))
+    overlaps = np.abs(rng.normal(0, 0.1, (lines.shape[0], observed)))
+    overlaps[:, 0] += recall * (1 - np.exp(-np.maximum(lines - tmin, 0) / 50))
+    overlaps = np.where(started[:, np.newaxis], np.minimum(overlaps, 1), 0)
+    max_overlap = overlaps.max(axis=1)
+    fluctuations = pd.Series(max_overlap).rolling(flush2, min_periods=1).std(ddof=0).to_numpy()
+    windows = np.where(started[:, np.newaxis], rng.integers(1, 41, overlaps.shape) * 5, 0)
+    q3 = np.column_stack([
+        np.full((lines.shape[0], 3), (sigma, delta, alpha)), np.full(lines.shape[0], tmin), last_spike, spikes_in_window,
+        overlaps.argmax(axis=1), max_overlap, fluctuations, np.stack([windows, overlaps], axis=2).reshape(lines.shape[0], -1)
+    ])
+    with open(os.path.join(run_dir, f'q3-{name}.dat'), 'w') as file:
+        write_table(file, q3, '%12g' + ' %12g' * 8 + ' %6d %12g' * observed + '\n')
+
+    with open(os.path.join(run_dir, f'output-{name}.txt'), 'w') as file:
+        file.write(output_template.format(run_dir=run_dir, name=name, number_patterns=number_patterns, mixing_range=mixing_range,
+                                          sigma=sigma, delta=delta, alpha=alpha, spikes=number_spikes, stop=stop,
+                                          run_rate=number_spikes / N / (stop / 1000), **parameters))
+
+def write_table(file, values: np.ndarray, row_format: str, chunksize: int=100_000):
+    """
+    Writes the rows of values with row_format (like '%12g %12g\\n'), NaN as '-nan' like the simulations.
+    The rows are formatted a chunk at a time with a single % on the whole chunk, much faster than np.savetxt.
+    """
+    for first in range(0, values.shape[0], chunksize):
+        chunk = values[first:first + chunksize]
+        file.write(((row_format * chunk.shape[0]) % tuple(chunk.ravel().tolist())).replace(' nan', '-nan'))
+
+# output file of a run, only the parameters (the simulations also describe the columns of the files)
+output_template = """seed=33333333333332  # generazione dei pattern, seed2 è per generare il noise
+seed2=0
+name={name}
+tmpdir={run_dir}/
+outdir={run_dir}/
+topo=random                    topologia connessioni
+S={S}                           numero siti
+G={G}                            siti del pattern
+Z={Z}                           neuroni per sito
+K={K}                           neuroni per sito del pattern
+sort=2                         tipo di sorting dei neuroni
+range={mixing_range}                      range di spread delle fasi
+P={number_patterns}                           numero pattern
+f=8                            frequenza di learning (Hz)
+noise=0                        0: rumore gaussiano, 1: rumore costante
+alpha={alpha:g}                      ampiezza rumore
+rho=1                          rate rumore (ms^-1)
+sigma={sigma:g}                        forza connessioni eccitatorie (E0)
+delta={delta:g}                        forza connessioni inibitorie (I0)
+bin=1                          bin temporale (ms)
+flush={flush}                       ogni quanti bin scrive medie e overlap
+flush2={flush2}                      su quanti flush calcola fluttuazioni overlap
+tmax={tmax}                       tempo massimo simulazione
+pout={pout}                       numero massimo di pattern osservati
+tmin={tmin}                       start calcolo overlap
+maxsp=1048576                  numero massimo di spike scritte su file
+maxsp2=1000000                 numero massimo di spike
+t={stop} ms ({run_rate:g} Hz/neurone) spike totali: {spikes} (numero di spike scritte {spikes})
+"""
+
+
+if __name__ == "__main__":
+    generate_sweep(r'./synthetic_simulation')
@@ -0,0 +1,39 @@
+# Run from the folder of the repository with: python -m pytest tests
+# The import of simulation_class is measured in a new python process, the one of pytest has already imported
+# pandas, numpy (and maybe matplotlib).
+
+import os
+import subprocess
+import sys
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_dir)
+
+from simulation_class import import_time_budget, plotting_modules
+
+
+def cold_import(code: str) -> subprocess.CompletedProcess:
+    """Runs code in a new python process with -X importtime, in the folder of the repository"""
+    return subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=repository_dir,
+                          capture_output=True, text=True, check=True)
+
+
+def test_no_plotting_modules():
+    result = cold_import(
+        "import sys\n"
+        "import simulation_class\n"
+        f"print(','.join(m for m in {plotting_modules!r} if m in sys.modules))\n"
+    )
+    assert result.stdout.strip() == '', f"import simulation_class also imports {result.stdout.strip()}"
+
+
+def test_import_time_budget():
+    result = cold_import("import simulation_class")
+    # lines of -X importtime: "import time: self [us] | cumulative | imported package"
+    cumulative = {
+        fields[2].strip(): int(fields[1])
+        for fields in (line.split('|') for line in result.stderr.splitlines() if line.startswith('import time:'))
+        if fields[1].strip().isdigit()
+    }
+    seconds = cumulative['simulation_class'] / 1e6
+    assert seconds < import_time_budget, f"import simulation_class takes {seconds:.3f} s, more than {import_time_budget} s"
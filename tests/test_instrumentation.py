@@ -0,0 +1,24 @@
+# Run from the folder of the repository with: python -m pytest tests
+
+import os
+import sys
+
+repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repository_dir)
+
+import instrumentation
+from simulation_class import Simulation
+
+
+def test_enable_after_the_simulation_is_made():
+    simulation = Simulation(repository_dir, 'example_simulation')
+    instrumentation.reset()
+    instrumentation.enable()
+    try:
+        simulation.pivot_df('max overlap', 2, 1.0, 1)
+    finally:
+        instrumentation.disable()
+    # the caches made in __init__ call the wrappers of enable
+    assert instrumentation.records['Simulation._make_pivot'][0] == 1
+    assert instrumentation.records['Simulation._read_slice'][0] == 1
+    instrumentation.reset()
@@ -0,0 +1,30 @@
+# Run from the folder of the repository with: python -m pytest tests
+
+import os
+import sys
+
+import matplotlib
+matplotlib.use('Agg')
+from matplotlib.figure import Figure
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from make_fig_spikes import plot_spike_density
+
+
+def test_single_instant_window():
+    ax = Figure().subplots()
+    spike_times = np.full(5, 100.)
+    neuron_ids = np.array([0, 3, 3, 7, 9])
+    cue = np.array([False, False, True, False, True])
+    plot_spike_density(ax, spike_times, neuron_ids, cue, time_ini=100., t_max=100., greatest_neuron=9)
+
+    images = ax.get_images()
+    assert len(images) == 2
+    for image in images:
+        left, right, bottom, top = image.get_extent()
+        assert left < 100. < right
+        assert image.get_array().shape == (10, 1)
+    # all the spikes are drawn, cue and non cue
+    assert sum(image.get_array().sum() for image in images) == 5